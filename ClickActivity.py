@@ -10,6 +10,12 @@
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
 
+import time
+_IMPORT_START = time.time()
+
+import json
+import os
+
 from gi.repository import Gtk,Gdk
 from sugar3.activity import activity
 from sugar3 import profile
@@ -17,8 +23,7 @@ from sugar3.graphics.toolbarbox import ToolbarBox
 from sugar3.activity.widgets import ActivityToolbarButton
 from sugar3.activity.widgets import StopButton
 
-from toolbar_utils import button_factory, label_factory, separator_factory, \
-                          radio_factory
+from toolbar_utils import label_factory, separator_factory
 
 from gettext import gettext as _
 
@@ -27,6 +32,8 @@ from game import Game
 import logging
 _logger = logging.getLogger('click-activity')
 
+_IMPORT_END = time.time()
+
 
 class ClickActivity(activity.Activity):
     """ Interactive reading game """
@@ -34,6 +41,10 @@ class ClickActivity(activity.Activity):
     def __init__(self, handle):
         """ Initialize the toolbars and the game board """
         super(ClickActivity, self).__init__(handle)
+        self._phases = [('import', _IMPORT_END - _IMPORT_START)]
+        self._game = None
+        self._snapshot = None  # read from the Journal before the game
+        start = time.time()
 
         self.nick = profile.get_nick_name()
         if profile.get_color() is not None:
@@ -42,6 +53,7 @@ class ClickActivity(activity.Activity):
             self.colors = ['#A0FFA0', '#FF8080']
 
         self._setup_toolbars()
+        start = self._end_phase('toolbar', start)
 
         # Create a canvas
         canvas = Gtk.DrawingArea()
@@ -50,9 +62,68 @@ class ClickActivity(activity.Activity):
         self.set_canvas(canvas)
         canvas.show()
         self.show_all()
-
-        self._game = Game(canvas, parent=self, colors=self.colors)
-
+        start = self._end_phase('canvas', start)
+
+        # e.g., YELLOW_DOT_MOTION=replay:/tmp/shake.trace YELLOW_DOT_SEED=1
+        # YELLOW_DOT_STATS=/tmp/draw-stats.json YELLOW_DOT_GESTURES=1
+        seed = os.environ.get('YELLOW_DOT_SEED')
+        if seed is not None:
+            seed = int(seed)
+        self._game = Game(canvas, parent=self, colors=self.colors,
+                          motion=os.environ.get('YELLOW_DOT_MOTION'),
+                          seed=seed,
+                          stats=os.environ.get('YELLOW_DOT_STATS'),
+                          gestures='YELLOW_DOT_GESTURES' in os.environ)
+        if self._snapshot is not None:
+            self._resume()
+        self._draw_start = self._end_phase('assets', start)
+        self._draw_id = canvas.connect_after('draw', self._first_draw_cb)
+
+    def _end_phase(self, name, start):
+        """ Note how long a startup phase took; return the time now """
+        now = time.time()
+        self._phases.append((name, now - start))
+        return now
+
+    def _first_draw_cb(self, canvas, cr):
+        """ Log the startup phases once the game is on the screen """
+        canvas.disconnect(self._draw_id)
+        self._end_phase('first draw', self._draw_start)
+        phases = ['%s %.3fs' % (name, seconds)
+                  for name, seconds in self._phases]
+        _logger.info('startup: %s (total %.3fs)' % (
+                ', '.join(phases), time.time() - _IMPORT_START))
+        return False
+
+    def write_file(self, file_path):
+        """ Save the state of the game to the Journal """
+        fd = open(file_path, 'w')
+        json.dump(self._game.get_snapshot(), fd)
+        fd.close()
+
+    def read_file(self, file_path):
+        """ Resume the game from the snapshot saved in the Journal """
+        try:
+            fd = open(file_path, 'r')
+            snapshot = json.load(fd)
+            fd.close()
+        except (IOError, ValueError), e:
+            _logger.error('cannot read %s: %s' % (file_path, e))
+            return
+        self._snapshot = snapshot
+        if self._game is not None:  # else, once the game is built
+            self._resume()
+
+    def _resume(self):
+        """ Rebuild the scene from the snapshot read from the Journal """
+        if not self._game.restore_snapshot(self._snapshot):
+            _logger.error('cannot resume from the snapshot in the Journal')
+        self._snapshot = None
+
+    def can_close(self):
+        """ Stop the game before the activity goes away """
+        self._game.stop()
+        return True
 
     def _setup_toolbars(self):
         """ Setup the toolbars. """
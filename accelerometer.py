@@ -0,0 +1,229 @@
+#Copyright (c) 2026 Yellow Dot contributors
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+
+accelerometer.py samples the accelerometer in a background thread.
+
+The device is opened once. A sysfs position file (or any regular file
+holding "(x,y,z)") is re-read from offset 0 at a fixed rate; an evdev
+input device or a FIFO is read as events arrive. Each sample goes into a
+fixed-size ring buffer and through a low-pass filter, and latest()
+returns the most recent filtered reading without touching the device,
+so the UI thread never opens or parses anything.
+
+For testing without XO hardware, pass the path of a FIFO (or a file)
+and write lines such as "(120,-36,1008)" to it.
+
+Example usage:
+        accelerometer = Accelerometer()
+        accelerometer.start()
+        ...
+        x, y, z = accelerometer.latest()
+        ...
+        accelerometer.stop()
+
+'''
+
+from gi.repository import GObject
+import glob
+import os
+import select
+import stat
+import struct
+import threading
+import time
+from collections import deque
+
+import logging
+_logger = logging.getLogger('click-activity')
+
+ACCELEROMETER_DEVICE = '/sys/devices/platform/lis3lv02d/position'
+INPUT_DEVICE_NAME = 'ST LIS3LV02DL Accelerometer'
+
+# struct input_event from linux/input.h: timeval, type, code, value
+INPUT_EVENT = 'llHHi'
+INPUT_EVENT_SIZE = struct.calcsize(INPUT_EVENT)
+EV_SYN = 0
+EV_ABS = 3
+
+SYSFS = 'sysfs'
+EVDEV = 'evdev'
+FIFO = 'fifo'
+
+
+def find_input_device(name=INPUT_DEVICE_NAME):
+    ''' Return the /dev/input/event* node of a named input device '''
+    for path in glob.glob('/sys/class/input/event*/device/name'):
+        try:
+            fh = open(path)
+            device_name = fh.read().strip()
+            fh.close()
+        except IOError:
+            continue
+        if device_name == name:
+            return os.path.join('/dev/input', path.split('/')[4])
+    return None
+
+
+def device_kind(path):
+    ''' How a device node is read: FIFO, EVDEV or SYSFS '''
+    mode = os.stat(path).st_mode
+    if stat.S_ISFIFO(mode):
+        return FIFO
+    elif stat.S_ISCHR(mode):
+        return EVDEV
+    return SYSFS
+
+
+def parse_position(string):
+    ''' Parse "(x,y,z)" into a tuple of floats '''
+    xyz = string.strip().strip('()').split(',')
+    return (float(xyz[0]), float(xyz[1]), float(xyz[2]))
+
+
+class Accelerometer:
+    ''' Background sampling of an accelerometer device '''
+
+    def __init__(self, path=None, rate=10, size=32, smoothing=0.5):
+        ''' path defaults to the evdev device of the XO or, failing that
+        (it is often not readable by the activity), the sysfs one; rate
+        is in samples per second (for devices that have to be polled);
+        smoothing is the weight given to each new sample (1 = none). '''
+        if path is None:
+            paths = [find_input_device(), ACCELEROMETER_DEVICE]
+        else:
+            paths = [path]
+        self._devices = []  # (path, kind) to try opening, in order
+        for path in paths:
+            if path is not None and os.access(path, os.R_OK):
+                self._devices.append((path, device_kind(path)))
+        self._path = None
+        self._kind = None
+        if len(self._devices) > 0:
+            self._path, self._kind = self._devices[0]
+        self._interval = 1. / rate
+        self._smoothing = smoothing
+        self._samples = deque(maxlen=size)  # (time, x, y, z), raw
+        self._filtered = None
+        self._fd = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    @property
+    def available(self):
+        ''' Is there a device to read? '''
+        return self._kind is not None
+
+    def start(self):
+        ''' Open the device and start sampling '''
+        if self._thread is not None:
+            return
+        while self._fd is None and len(self._devices) > 0:
+            self._path, self._kind = self._devices[0]
+            try:
+                flags = os.O_RDONLY
+                if self._kind != SYSFS:
+                    flags |= os.O_NONBLOCK
+                self._fd = os.open(self._path, flags)
+            except OSError, e:
+                _logger.error('accelerometer: cannot open %s: %s' % (
+                        self._path, e))
+                self._devices.pop(0)  # and try the next one
+        if self._fd is None:
+            self._path, self._kind = None, None
+            return
+        GObject.threads_init()
+        self._stopping.clear()
+        if self._kind == SYSFS:
+            target = self._poll
+        else:
+            target = self._stream
+        self._thread = threading.Thread(target=target)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        ''' Stop sampling and close the device '''
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        os.close(self._fd)
+        self._fd = None
+
+    def latest(self):
+        ''' The most recent filtered (x, y, z), or None '''
+        return self._filtered
+
+    def samples(self):
+        ''' The raw (time, x, y, z) samples in the ring buffer '''
+        return list(self._samples)
+
+    def _add_sample(self, x, y, z):
+        self._samples.append((time.time(), x, y, z))
+        if self._filtered is None:
+            self._filtered = (x, y, z)
+        else:
+            a = self._smoothing
+            fx, fy, fz = self._filtered
+            self._filtered = (fx + a * (x - fx), fy + a * (y - fy),
+                              fz + a * (z - fz))
+
+    def _read_position(self):
+        if hasattr(os, 'pread'):
+            return os.pread(self._fd, 64, 0)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        return os.read(self._fd, 64)
+
+    def _poll(self):
+        ''' Re-read a position file at a fixed rate '''
+        while not self._stopping.is_set():
+            try:
+                self._add_sample(*parse_position(self._read_position()))
+            except (OSError, ValueError, IndexError), e:
+                _logger.debug('accelerometer: bad reading: %s' % (e))
+            self._stopping.wait(self._interval)
+
+    def _stream(self):
+        ''' Read events from an evdev device or lines from a FIFO '''
+        pending = ''
+        xyz = [0, 0, 0]
+        while not self._stopping.is_set():
+            ready = select.select([self._fd], [], [], self._interval)[0]
+            if len(ready) == 0:
+                continue
+            try:
+                data = os.read(self._fd, 64 * INPUT_EVENT_SIZE)
+            except OSError:
+                continue
+            if len(data) == 0:  # the writer closed the FIFO
+                self._stopping.wait(self._interval)
+                continue
+            pending += data
+            if self._kind == EVDEV:
+                n = len(pending) - len(pending) % INPUT_EVENT_SIZE
+                for i in range(0, n, INPUT_EVENT_SIZE):
+                    sec, usec, type, code, value = struct.unpack(
+                        INPUT_EVENT, pending[i:i + INPUT_EVENT_SIZE])
+                    if type == EV_ABS and code < 3:
+                        xyz[code] = value
+                    elif type == EV_SYN:
+                        self._add_sample(*xyz)
+                pending = pending[n:]
+            else:
+                lines = pending.split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    try:
+                        self._add_sample(*parse_position(line))
+                    except (ValueError, IndexError):
+                        pass
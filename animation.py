@@ -0,0 +1,150 @@
+#Copyright (c) 2026 Yellow Dot contributors
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+
+animation.py drives sprite motion from the frame clock of a widget.
+
+It offers two things, both serviced in a single pass per frame:
+
+  * a fixed-timestep callback (the game physics), run as many times as
+    the elapsed frame time calls for; and
+  * tweens, which move a sprite smoothly to a new position.
+
+Physics moves sprites with glide(), a linear tween that lasts exactly
+one timestep, so motion is interpolated between physics steps at the
+display rate. target() returns where a sprite is headed, which is what
+the physics should reason about.
+
+Example usage:
+        animator = Animator(canvas, timestep=0.1, sprites=sprites)
+        animator.start_steps(physics_cb)
+        animator.animate_to(sprite, (x, y), 0.5)
+
+'''
+
+from gi.repository import GObject
+import time
+
+# Never run more than this many seconds of physics in one frame.
+MAX_FRAME_TIME = 0.25
+# Frame interval used when there is no frame clock (in milliseconds)
+FALLBACK_INTERVAL = 16
+
+
+class Animator:
+    ''' Tweens and fixed-timestep physics on a widget's frame clock '''
+
+    def __init__(self, widget, timestep=0.1, sprites=None):
+        ''' sprites, if given, is flushed after each frame's changes '''
+        self._widget = widget
+        self._sprites = sprites
+        self._timestep = timestep
+        self._step_cb = None
+        self._accumulator = 0
+        self._last = None
+        self._tick_id = None
+        self._timeout_id = None
+        # sprite --> [x0, y0, x1, y1, start, duration, ease, done_cb]
+        self._tweens = {}
+
+    def start_steps(self, callback):
+        ''' Call callback once per timestep until stop_steps '''
+        if self._step_cb is None:
+            self._accumulator = 0
+        self._step_cb = callback
+        self._start_ticking()
+
+    def stop_steps(self):
+        ''' Stop calling the timestep callback '''
+        self._step_cb = None
+
+    def animate_to(self, sprite, pos, duration, done_cb=None, ease=True):
+        ''' Move a sprite to pos over duration seconds '''
+        x0, y0 = sprite.get_xy()
+        self._tweens[sprite] = [x0, y0, pos[0], pos[1], None, duration,
+                                ease, done_cb]
+        self._start_ticking()
+
+    def glide(self, sprite, pos):
+        ''' Move a sprite to pos over the next timestep '''
+        self.animate_to(sprite, pos, self._timestep, ease=False)
+
+    def target(self, sprite):
+        ''' Where is the sprite going to end up? '''
+        if sprite in self._tweens:
+            tween = self._tweens[sprite]
+            return (tween[2], tween[3])
+        return sprite.get_xy()
+
+    def cancel(self, sprite):
+        ''' Stop tweening a sprite, leaving it where it is '''
+        if sprite in self._tweens:
+            del self._tweens[sprite]
+
+    def is_animating(self):
+        ''' Are there tweens or a timestep callback pending? '''
+        return self._step_cb is not None or len(self._tweens) > 0
+
+    def _start_ticking(self):
+        if self._tick_id is not None or self._timeout_id is not None:
+            return
+        self._last = None
+        if self._widget is not None and \
+                hasattr(self._widget, 'add_tick_callback'):
+            self._tick_id = self._widget.add_tick_callback(self._tick)
+        else:
+            self._timeout_id = GObject.timeout_add(FALLBACK_INTERVAL,
+                                                   self._tick)
+
+    def _tick(self, widget=None, frame_clock=None):
+        ''' Run the physics and advance the tweens for one frame '''
+        if frame_clock is not None:
+            now = frame_clock.get_frame_time() / 1000000.
+        else:
+            now = time.time()
+        self.advance(now)
+        if self._sprites is not None:
+            # Inside the frame clock, so the changes are drawn this frame
+            self._sprites.flush()
+        if self.is_animating():
+            return True
+        self._tick_id = None
+        self._timeout_id = None
+        return False
+
+    def advance(self, now):
+        ''' Bring physics and tweens up to time now (in seconds) '''
+        if self._last is None:
+            self._last = now
+        if self._step_cb is not None:
+            self._accumulator += min(now - self._last, MAX_FRAME_TIME)
+            while self._accumulator >= self._timestep and \
+                    self._step_cb is not None:
+                self._accumulator -= self._timestep
+                self._step_cb()
+        self._last = now
+
+        for sprite, tween in self._tweens.items():
+            x0, y0, x1, y1, start, duration, ease, done_cb = tween
+            if start is None:  # starts on the first frame it is seen
+                start = tween[4] = now
+            if duration > 0:
+                t = min((now - start) / duration, 1.)
+            else:
+                t = 1.
+            if ease:
+                t = t * t * (3 - 2 * t)
+            sprite.move((int(round(x0 + (x1 - x0) * t)),
+                         int(round(y0 + (y1 - y0) * t))))
+            if t >= 1. and self._tweens.get(sprite) is tween:
+                del self._tweens[sprite]
+                if done_cb is not None:
+                    done_cb(sprite)
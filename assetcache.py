@@ -0,0 +1,108 @@
+#Copyright (c) 2026 Yellow Dot contributors
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+
+assetcache.py keeps rasterized cairo image surfaces on disk so that the
+next launch can map them back in instead of rendering them again.
+
+Each surface is stored as its raw pixel data, exactly as cairo holds it
+in memory, and loaded with mmap and cairo.ImageSurface.create_for_data.
+The cache lives in a directory named after CACHE_VERSION and a digest of
+the key (screen geometry, dot size, palette, ...), so a change to any
+part of the key selects a fresh directory; stale ones are removed.
+
+Example usage:
+        cache = AssetCache(path, (width, height, dot_size, colors))
+        surface = cache.load('dots', cairo.FORMAT_ARGB32, w, h)
+        if surface is None:
+            surface = render_the_dots()
+            cache.save('dots', surface)
+
+'''
+
+import hashlib
+import mmap
+import os
+import shutil
+
+import cairo
+
+import logging
+_logger = logging.getLogger('click-activity')
+
+# Bump this whenever the way assets are drawn changes.
+CACHE_VERSION = 2
+
+
+class AssetCache:
+    ''' A directory of raw image surfaces keyed by rendering parameters '''
+
+    def __init__(self, root, key):
+        ''' Select (and clean up around) the directory for this key '''
+        self._root = root
+        digest = hashlib.md5(repr(key)).hexdigest()[:16]
+        self._name = 'v%d-%s' % (CACHE_VERSION, digest)
+        self._path = os.path.join(root, self._name)
+        self._maps = []
+        self._remove_stale()
+
+    def _remove_stale(self):
+        ''' Remove cache directories left behind by other keys '''
+        if not os.path.isdir(self._root):
+            return
+        for name in os.listdir(self._root):
+            if name != self._name:
+                shutil.rmtree(os.path.join(self._root, name),
+                              ignore_errors=True)
+
+    def _filename(self, name, format, width, height):
+        return os.path.join(self._path, '%s-%d-%dx%d.raw' % (
+                name, format, width, height))
+
+    def load(self, name, format, width, height):
+        ''' Map a cached surface back in; return None on a miss '''
+        path = self._filename(name, format, width, height)
+        stride = cairo.ImageSurface.format_stride_for_width(format, width)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            if os.fstat(fd).st_size != stride * height:
+                _logger.debug('assetcache: discarding truncated %s' % (path))
+                return None
+            # ACCESS_COPY gives cairo a writable, private view of the file.
+            data = mmap.mmap(fd, 0, access=mmap.ACCESS_COPY)
+        except (EnvironmentError, mmap.error):
+            return None
+        finally:
+            os.close(fd)
+        # Hang on to the mapping for as long as the surface may be used.
+        self._maps.append(data)
+        return cairo.ImageSurface.create_for_data(data, format, width,
+                                                  height, stride)
+
+    def save(self, name, surface):
+        ''' Write the pixel data of an image surface to the cache '''
+        path = self._filename(name, surface.get_format(), surface.get_width(),
+                              surface.get_height())
+        surface.flush()
+        try:
+            if not os.path.isdir(self._path):
+                os.makedirs(self._path)
+            tmp = path + '.tmp'
+            fh = open(tmp, 'wb')
+            fh.write(surface.get_data())
+            fh.close()
+            # Rename so that a partially written file is never loaded.
+            os.rename(tmp, path)
+        except EnvironmentError, e:
+            _logger.debug('assetcache: could not write %s: %s' % (path, e))
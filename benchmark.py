@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#Copyright (c) 2026 Yellow Dot contributors
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+
+benchmark.py times the rendering and input hot paths of the game.
+
+The game is run headless (see Game.render_frame), so no display or
+Sugar session is needed. Each metric is measured for every combination
+of canvas size, dot grid and sprite count; extra sprites are scattered
+over the dots to load the sprite engine. Results are microseconds per
+call (the best of several repeats), written as JSON.
+
+Example usage:
+        ./benchmark.py --output new.json
+        ./benchmark.py --baseline old.json --threshold 10
+        ./benchmark.py --tolerance 2
+
+With --baseline, the exit status is 1 if any metric is more than
+threshold percent slower than in the baseline. With --tolerance, nothing
+is timed: a frame with every shade of dot is drawn by each renderer, and
+the exit status is 1 if the two differ by more than tolerance in any
+color channel of any pixel.
+
+'''
+
+import argparse
+import itertools
+import json
+import random
+import sys
+import time
+
+import cairo
+
+import game
+from sprites import Sprite, CAIRO_RGBA
+
+# (x, y, z) readings fed to motion_cb
+READING = (-3, 0, 2)
+SHAKE_MODES = ['random', 'random2', 'align', 'left', 'right']
+POINTS = 256  # positions cycled through by find_sprite
+
+
+def measure(callback, number, repeat):
+    ''' Best time, in microseconds, of one call to callback '''
+    best = None
+    for r in range(repeat):
+        start = time.time()
+        for i in xrange(number):
+            callback()
+        elapsed = (time.time() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000000
+
+
+def make_game(size, grid, sprites, renderer):
+    ''' A headless game with extra sprites scattered over the dots '''
+    g = game.Game(None, seed=1, motion='synthetic:1', size=size,
+                  renderer=renderer, grid=grid)
+    choice = random.Random(sprites)
+    dot = g._new_dot(g._colors[game.BLUE])
+    for i in range(sprites):
+        spr = Sprite(g._sprites,
+                     int(choice.uniform(0, size[0] - g._dot_size)),
+                     int(choice.uniform(0, size[1] - g._dot_size)), dot)
+        spr.type = None
+        spr.set_layer(int(choice.uniform(100, 200)))
+    for i, dot in enumerate(g._dots):
+        dot.type = [game.YELLOW, game.RED, game.BLUE, game.DOT][i % 4]
+    g.render_frame(full=True)
+    return g
+
+
+def run(size, grid, sprites, renderer, number, repeat):
+    ''' Return {metric: microseconds} for one configuration '''
+    g = make_game(size, grid, sprites, renderer)
+    results = {}
+    color = g._colors[game.YELLOW]
+
+    g._fill = color
+    g._stroke = color
+    g._svg_width = g._dot_size
+    g._svg_height = g._dot_size
+    svg = g._header() + g._circle(g._dot_size / 2., g._dot_size / 2.,
+                                  g._dot_size / 2.) + g._footer()
+    results['svg_str_to_pixbuf'] = measure(
+        lambda: game.svg_str_to_pixbuf(svg), number, repeat)
+
+    def cold_dot():
+        g._atlas = None  # render the whole palette again
+        g._new_dot(color)
+    results['new_dot_cold'] = measure(cold_dot, number, repeat)
+    results['new_dot_warm'] = measure(lambda: g._new_dot(color),
+                                      number * 10, repeat)
+
+    choice = random.Random(0)
+    points = itertools.cycle(
+        [(int(choice.uniform(0, size[0])), int(choice.uniform(0, size[1])))
+         for i in range(POINTS)])
+    results['find_sprite'] = measure(
+        lambda: g._sprites.find_sprite(points.next()), number * 10, repeat)
+
+    layers = itertools.cycle([(dot, layer) for dot in g._dots
+                              for layer in [100, 150]])
+
+    def set_layer():
+        dot, layer = layers.next()
+        dot.set_layer(layer)
+    results['set_layer'] = measure(set_layer, number * 10, repeat)
+    g._sprites.take_damage()
+
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, size[0], size[1])
+    cr = cairo.Context(surface)
+    results['redraw_full'] = measure(
+        lambda: g._sprites.redraw_sprites(area=(0, 0, size[0], size[1]),
+                                          cr=cr), number, repeat)
+    x, y = g._dots[len(g._dots) / 2].get_xy()
+    area = (x, y, g._dot_size, g._dot_size)
+
+    def redraw_clipped():
+        cr.save()
+        cr.rectangle(*area)
+        cr.clip()
+        g._sprites.redraw_sprites(area=area, cr=cr)
+        cr.restore()
+    results['redraw_clipped'] = measure(redraw_clipped, number, repeat)
+
+    g._dots[0].set_label(':)')
+    results['draw_label'] = measure(lambda: g._dots[0].draw_label(cr),
+                                    number, repeat)
+
+    for mode in SHAKE_MODES:
+        g._shake = mode
+        g._gather_moving()
+
+        def tick():
+            g._pausing = True  # keep the stages from advancing
+            g.motion_cb(*READING)
+        results['motion_cb_' + mode] = measure(tick, number, repeat)
+    g.stop()
+    return results
+
+
+def render(size, grid, renderer):
+    ''' The pixels of a full frame with every shade of dot in it '''
+    g = game.Game(None, seed=1, motion='synthetic:1', size=size,
+                  renderer=renderer, grid=grid)
+    for i, dot in enumerate(g._dots):
+        dot.set_shape(g._new_dot(g._colors[i % len(g._colors)]))
+    frame = g.render_frame(full=True)
+    frame.flush()
+    pixels = str(frame.get_data())
+    g.stop()
+    return pixels
+
+
+def renderer_delta(size, grid):
+    ''' The largest difference, in any color channel of any pixel, between
+    frames drawn by the SVG and cairo renderers '''
+    svg = render(size, grid, game.SVG_RENDERER)
+    drawn = render(size, grid, game.CAIRO_RENDERER)
+    unused = CAIRO_RGBA[3]  # the padding byte of an RGB24 pixel
+    if game.numpy is not None:
+        a = game.numpy.frombuffer(svg, game.numpy.uint8).reshape(-1, 4)
+        b = game.numpy.frombuffer(drawn, game.numpy.uint8).reshape(-1, 4)
+        delta = abs(a.astype(int) - b)
+        delta[:, unused] = 0
+        return int(delta.max())
+    worst = 0
+    for i in xrange(len(svg)):
+        if i % 4 != unused:
+            worst = max(worst, abs(ord(svg[i]) - ord(drawn[i])))
+    return worst
+
+
+def compare(results, baseline, threshold):
+    ''' Return the metrics that are more than threshold percent slower '''
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline or baseline[name] <= 0:
+            continue
+        change = (results[name] - baseline[name]) * 100. / baseline[name]
+        if change > threshold:
+            regressions.append((name, baseline[name], results[name],
+                                change))
+    return regressions
+
+
+def parse_size(string):
+    ''' '1200x787' --> (1200, 787); also used for grids '''
+    w, h = string.lower().split('x')
+    return (int(w), int(h))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the game')
+    parser.add_argument('--sizes', default='1200x787',
+                        help='canvas sizes, e.g. 1200x787,800x600')
+    parser.add_argument('--grids', default='9x5,60x40',
+                        help='dot grids (columns x rows), e.g. 9x5,60x40')
+    parser.add_argument('--sprites', default='0,1000',
+                        help='sprite counts (beyond the number of dots)')
+    parser.add_argument('--renderer', default=game.SVG_RENDERER,
+                        choices=[game.SVG_RENDERER, game.CAIRO_RENDERER])
+    parser.add_argument('--number', type=int, default=20,
+                        help='calls per repeat')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write the JSON results here')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=10.,
+                        help='percent slowdown counted as a regression')
+    parser.add_argument('--tolerance', type=int,
+                        help='compare the renderers instead of timing them')
+    args = parser.parse_args(argv)
+
+    if args.tolerance is not None:
+        status = 0
+        for size in [parse_size(s) for s in args.sizes.split(',')]:
+            for grid in [parse_size(s) for s in args.grids.split(',')]:
+                delta = renderer_delta(size, grid)
+                print '%dx%d/%dx%d: max channel delta %d' % (
+                    size[0], size[1], grid[0], grid[1], delta)
+                if delta > args.tolerance:
+                    status = 1
+        return status
+
+    results = {}
+    for size in [parse_size(s) for s in args.sizes.split(',')]:
+        for grid in [parse_size(s) for s in args.grids.split(',')]:
+            for sprites in [int(n) for n in args.sprites.split(',')]:
+                config = '%dx%d/%dx%d/%d' % (size[0], size[1], grid[0],
+                                             grid[1], sprites)
+                for name, value in run(size, grid, sprites, args.renderer,
+                                       args.number, args.repeat).items():
+                    results['%s/%s' % (name, config)] = value
+
+    report = {'renderer': args.renderer,
+              'numpy': game.numpy is not None,
+              'unit': 'us',
+              'results': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is not None:
+        fh = open(args.output, 'w')
+        fh.write(output + '\n')
+        fh.close()
+    else:
+        print output
+
+    if args.baseline is not None:
+        fh = open(args.baseline)
+        baseline = json.load(fh)['results']
+        fh.close()
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new, change in regressions:
+            sys.stderr.write('%s: %.1f -> %.1f us (+%.0f%%)\n' % (
+                name, old, new, change))
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,47 +13,44 @@
 from gi.repository import Gtk, GdkPixbuf, GObject, Gdk
 import cairo
 import os
-from random import uniform
+from math import pi
+import hashlib
+import random
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from gettext import gettext as _
 
 import logging
 _logger = logging.getLogger('reflection-activity')
 
-from sugar3.graphics import style
-GRID_CELL_SIZE = style.GRID_CELL_SIZE
-
-from sprites import Sprites, Sprite
-
-
-ACCELEROMETER_DEVICE = '/sys/devices/platform/lis3lv02d/position'
-
-
-def read_accelerometer(game):
-    if not hasattr(read_accelerometer, 'device_path'):
-        if os.path.exists(ACCELEROMETER_DEVICE):
-            read_accelerometer.device_path = ACCELEROMETER_DEVICE
-        else:
-            read_accelerometer.device_path = None
-    if read_accelerometer.device_path is None:
-        x = int(uniform(-20, 20))
-        y = int(uniform(-20, 20))
-        z = int(uniform(-20, 20))
-    else:
-        fh = open(ACCELEROMETER_DEVICE)
-        string = fh.read()
-        xyz = string[1:-2].split(',')
-        x = int(float(xyz[0]) / 18)
-        y = int(float(xyz[1]) / 18)
-        z = int(float(xyz[2]) / 18)
-        fh.close()
-    game.motion_cb(x, y, z)
-
-
-# Grid dimensions must be even
-NINE = 9
-FIVE = 5
+try:
+    from sugar3.graphics import style
+    GRID_CELL_SIZE = style.GRID_CELL_SIZE
+except ImportError:  # e.g., running headless outside of Sugar
+    GRID_CELL_SIZE = 75
+
+from sprites import Sprites, Sprite, AtlasRegion
+from animation import Animator
+from motion import MotionSource, create_motion_source
+from stages import Stage, StageEngine
+from gestures import RubRecognizer
+from assetcache import AssetCache
+from instrument import DrawStats
+
+
+# Default grid dimensions (columns, rows)
+COLUMNS = 9
+ROWS = 5
+# Targets picked over a game: three yellow dots, then five more in each of
+# the yellow, red and blue tap stages. Each must be a different dot.
+MIN_DOTS = 3 + 3 * 5
 DOT_SIZE = 40
+ATLAS_COLUMNS = 4  # dots per row of the palette atlas
+PHYSICS_STEP = 0.1  # seconds between accelerometer readings
+SWAP_TIME = 0.5  # seconds for two dots to trade places
 YELLOW = 8
 RED = 4
 BLUE = 12
@@ -61,10 +58,75 @@ WHITE = 2
 BLACK = 3
 DOT = 0
 
+# The stages of the game: name --> (action, pause, delay)
+#   action: the method run when the stage advances
+#   pause:  None, 0 (wait for the physics to settle) or ms to wait before
+#           taps count again
+#   delay:  ms before the stage advances by itself (None: on input)
+STAGES = {
+    'yellow_dot': ('_yellow_dot', None, 500),
+    'yellow_dot_too': ('_yellow_dot_too', None, None),
+    'yellow_dots_three': ('_yellow_dots_three', None, None),
+    'red_dot': ('_red_dot', None, None),
+    'blue_dot': ('_blue_dot', None, None),
+    'yellow_tap': ('_yellow_tap', None, None),
+    'red_tap': ('_red_tap', None, None),
+    'blue_tap': ('_blue_tap', None, None),
+    'shake_it': ('_shake_it', None, 500),
+    'shake_it_more': ('_shake_it_more', 5000, None),
+    'turn_left': ('_turn_left', 5000, None),
+    'turn_right': ('_turn_right', 0, None),
+    'align': ('_align', 0, None),
+    'tap_six': ('_tap_six', 0, None),
+    'tap_six_too': ('_tap_six_too', None, None),
+    'tap_two': ('_tap_two', None, None),
+    'shake_three': ('_shake_three', None, 500),
+    'fade_it': ('_fade_it', 2000, None),
+    'fade_it_again': ('_fade_it_again', 2000, None),
+    'and_again': ('_and_again', 2000, None),
+    'one_last_time': ('_one_last_time', 2000, None),
+}
+
+# Bump this whenever the contents of get_snapshot change.
+SNAPSHOT_VERSION = 2
+SNAPSHOT_KEYS = ['version', 'grid', 'stage', 'targets', 'tapped', 'count',
+                 'release', 'rubbing', 'pausing', 'shake', 'backgrounds',
+                 'dots']
+
+# Rendering backends for dots and backgrounds
+SVG_RENDERER = 'svg'
+CAIRO_RENDERER = 'cairo'
+
 class Game():
 
-    def __init__(self, canvas, parent=None, colors=['#A0FFA0', '#FF8080']):
+    def __init__(self, canvas, parent=None, colors=['#A0FFA0', '#FF8080'],
+                 renderer=SVG_RENDERER, motion=None, seed=None, size=None,
+                 stats=None, grid=(COLUMNS, ROWS), dot_size=None,
+                 gestures=False):
+        ''' motion is a MotionSource, or a description of one for
+        create_motion_source; seed makes the game's choices repeatable.
+        With no canvas, the game runs headless at size (width, height)
+        and is drawn with render_frame. If stats is a path, drawing
+        statistics are collected and written there by stop. grid is the
+        (columns, rows) of dots, at least MIN_DOTS of them; by default,
+        dots are sized to fit. With gestures, rubbing is recognized from
+        the motion of the pointer rather than by holding it down for a
+        second. '''
         self._activity = parent
+        self._random = random.Random(seed)
+        # The motion gets a sequence of its own, apart from the choices.
+        motion_seed = self._random.getrandbits(32)
+        # So does the physics, drawn in the same order with or without
+        # numpy, so that a seeded game moves the same either way.
+        self._physics_random = random.Random(self._random.getrandbits(32))
+        self._moving = []  # the dots the physics moves...
+        self._xy = None  # ...and their positions, as a numpy array
+        if not isinstance(motion, MotionSource):
+            motion = create_motion_source(motion, motion_seed)
+        self._motion = motion
+        if renderer not in [SVG_RENDERER, CAIRO_RENDERER]:
+            raise ValueError('unknown renderer %s' % (renderer))
+        self._renderer = renderer
         self._colors = [colors[0]]
         self._colors.append(colors[1])
         self._colors.append('#FFFFFF')
@@ -87,95 +149,175 @@ class Game():
 
         self._canvas = canvas
         if parent is not None:
-            parent.show_all()
             self._parent = parent
 
-        self._canvas.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
-        self._canvas.add_events(Gdk.EventMask.BUTTON_RELEASE_MASK)
-        self._canvas.connect("draw", self.__draw_cb)
-        self._canvas.connect("button-press-event", self._button_press_cb)
-        self._canvas.connect("button-release-event", self._button_release_cb)
+        if self._canvas is not None:
+            self._canvas.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
+            self._canvas.add_events(Gdk.EventMask.BUTTON_RELEASE_MASK)
+            self._canvas.add_events(Gdk.EventMask.TOUCH_MASK)
+            self._canvas.connect("draw", self.__draw_cb)
+            self._canvas.connect("button-press-event", self._button_press_cb)
+            self._canvas.connect("button-release-event",
+                                 self._button_release_cb)
+            self._canvas.connect("touch-event", self._touch_cb)
         self._global_scale = 1
-        self._width = Gdk.Screen.width()
-        self._height = Gdk.Screen.height() - (GRID_CELL_SIZE * 1.5)
-        self._scale = self._width / (10 * DOT_SIZE * 1.2)
-        self._dot_size = int(DOT_SIZE * self._scale)
+        if size is not None:
+            self._width, self._height = size
+        else:
+            self._width = Gdk.Screen.width()
+            self._height = Gdk.Screen.height() - (GRID_CELL_SIZE * 1.5)
+        self._frame = None  # the last frame drawn by render_frame
+        self._columns, self._rows = grid
+        if self._columns < 1 or self._rows < 1 or \
+                self._columns * self._rows < MIN_DOTS:
+            raise ValueError('a %dx%d grid has too few dots (%d needed)' % (
+                    self._columns, self._rows, MIN_DOTS))
+        if dot_size is None:
+            # Leave a dot's worth of margin and a fifth of a dot between dots
+            dot_size = int(min(self._width / ((self._columns + 1) * 1.2),
+                               self._height / (self._rows * 1.2)))
+        self._dot_size = max(2, int(dot_size))
+        self._scale = self._dot_size / float(DOT_SIZE)
         self._space = int(self._dot_size / 5.)
+        self._xoffset = int((self._width - self._columns * self._dot_size -
+                             (self._columns - 1) * self._space) / 2.)
         self._press = False
         self._release = None
+        self._releases = []  # the dots tapped together, ending in _release
+        # sequence --> [x, y, sprite pressed, hit tested yet?, ended?]
+        self._touches = {}
+        self._touch_id = None
         self._rubbing = False
         self._tapped = None
         self._pausing = False
         self._count = 0
         self._targets = None  # click target
         self._shake = None  # accelerometer target
-        self._next = None
+        self._engine = StageEngine()
+        for name, (action, pause, delay) in STAGES.items():
+            timers = []
+            if pause > 0:
+                timers.append((pause, self._clear_pause))
+            on_enter = None
+            if pause is not None:
+                on_enter = self._pause
+            self._engine.add_stage(name, Stage(getattr(self, action),
+                                               on_enter, timers, delay))
+        self._rub_timer = None
         self.last_spr = None
         self._timer = None
         self.roygbiv = False
+        self._atlas = None  # every shade of dot, in one surface...
+        self._atlas_regions = {}  # ...color --> AtlasRegion...
+        self._atlas_pending = []  # ...and the colors not yet drawn in it
+        self._atlas_unmasked = []  # drawn, but without a hit-test mask
+        self._atlas_saved = False
+        self._prewarm_id = None
+        self.dot_cache_hits = 0
+        self.dot_cache_misses = 0
 
         # Generate the sprites we'll need...
         self._sprites = Sprites(self._canvas)
+        self._device_scale = self._sprites.get_scale_factor()
+        self._asset_cache = None
+        if parent is not None and hasattr(parent, 'get_activity_root'):
+            palette = hashlib.md5(','.join(self._colors)).hexdigest()
+            self._asset_cache = AssetCache(
+                os.path.join(parent.get_activity_root(), 'data', 'cache'),
+                (int(round(self._width)), int(round(self._height)),
+                 self._dot_size, palette, self._renderer,
+                 self._device_scale))
+        self._stats_path = stats
+        if stats:
+            self._sprites.stats = DrawStats()
+        self._animator = Animator(self._canvas, PHYSICS_STEP,
+                                  self._sprites)
+        self._rub = None
+        if gestures:
+            self._rub = RubRecognizer(self._sprites, self._rubbed)
+            if self._canvas is not None:
+                self._rub.attach(self._canvas)
 
         self._svg_width = self._width
         self._svg_height = self._height
         self._lightbg = Sprite(self._sprites, 0, 0,
-                            svg_str_to_pixbuf(
-                self._header() + \
-                self._rect(self._width, self._height, 0, 0) + \
-                self._footer()))
+                               self._new_background('#ffffff'))
         self._lightbg.set_label_attributes(24)
         self._lightbg._vert_align = ["bottom"]
 
-        self._darkbg = Sprite(self._sprites, 0, 0,
-                              svg_str_to_pixbuf(
-                self._header() + \
-                self._rect(self._width, self._height, 0, 0, color='#000000') + \
-                self._footer()))
-        self._darkbg.set_label_attributes(24)
-        self._darkbg._vert_align = ["bottom"]
-        self._darkbg.set_label_color('yellow')
-        self._darkbg.set_layer(0)
+        self._lightbg.dot_index = None
+        self._darkbg = None  # not needed until the tap_six stage
+
+        # Rasterize every shade up front so stage changes never have to.
+        self._prewarm_dots()
 
         self._dots = []
-        for y in range(FIVE):
-            for x in range(NINE):
-                xoffset = int((self._width - NINE * self._dot_size - \
-                                   (NINE - 1) * self._space) / 2.)
-                self._dots.append(
-                    Sprite(self._sprites,
-                           xoffset + x * (self._dot_size + self._space),
-                           y * (self._dot_size + self._space),
-                           self._new_dot(self._colors[WHITE])))
-                self._dots[-1].type = DOT
-                self._dots[-1].set_label_attributes(40)
-
-        n = FIVE / 2.
+        white = self._new_dot(self._colors[WHITE])
+        for i in range(self._columns * self._rows):
+            x, y = self._dot_home(i)
+            self._dots.append(Sprite(self._sprites, x, y, white))
+            self._dots[-1].type = DOT
+            self._dots[-1].dot_index = i
+            self._dots[-1].exact_hit = True  # not the corners
+            self._dots[-1].set_label_attributes(40)
 
         # and initialize a few variables we'll need.
         self._yellow_dot()
 
+    def _get_darkbg(self):
+        ''' The dark background, made the first time it is needed '''
+        if self._darkbg is None:
+            self._darkbg = Sprite(self._sprites, 0, 0,
+                                  self._new_background('#000000'))
+            self._darkbg.set_label_attributes(24)
+            self._darkbg._vert_align = ["bottom"]
+            self._darkbg.set_label_color('yellow')
+            self._darkbg.set_layer(0)
+            self._darkbg.dot_index = None
+        return self._darkbg
+
+    def _set_stage(self, name):
+        ''' Move on to the next stage of the game '''
+        self._releases = []
+        self._engine.enter(name)
+
+    def _pause(self):
+        self._pausing = True
+
     def _clear_pause(self):
         self._pausing = False
         if self._rubbing and self._release is not None:
-            if self._next is not None:
-                self._next()
+            self._engine.advance()
+
+    def live_timers(self):
+        ''' How many game timers are outstanding? '''
+        return self._engine.live_timers()
+
+    def _dot_home(self, i):
+        ''' Where dot i sits in the grid '''
+        col, row = self._dot_to_grid(i)
+        return (self._xoffset + col * (self._dot_size + self._space),
+                row * (self._dot_size + self._space))
+
+    def _new_target(self):
+        ''' Pick a dot that is not already a target '''
+        i = self._targets[0]
+        while i in self._targets:
+            i = int(self._random.uniform(0, len(self._dots)))
+        self._targets.append(i)
+        return i
 
     def _yellow_dot(self):
-        for y in range(FIVE):
-            for x in range(NINE):
-                xoffset = int((self._width - NINE * self._dot_size - \
-                                   (NINE - 1) * self._space) / 2.)
-                self._dots[x + y * NINE].move((
-                           xoffset + x * (self._dot_size + self._space),
-                           y * (self._dot_size + self._space)))
-                self._dots[x + y * NINE].set_shape(
-                    self._new_dot(self._colors[WHITE]))
-                self._dots[x + y * NINE].type = DOT
-                self._dots[x + y * NINE].set_layer(100)
+        white = self._new_dot(self._colors[WHITE])
+        for i, dot in enumerate(self._dots):
+            self._animator.cancel(dot)
+            dot.move(self._dot_home(i))
+            dot.set_shape(white)
+            dot.type = DOT
+        self._sprites.set_layers(self._dots, 100)
         self._lightbg.set_label(_('Tap on the yellow dot.'))
-        self._targets = [int(uniform(0, NINE * FIVE))]
-        self._next = self._yellow_dot_too
+        self._targets = [int(self._random.uniform(0, len(self._dots)))]
+        self._set_stage('yellow_dot_too')
         self._dots[self._targets[0]].set_shape(
             self._new_dot(self._colors[YELLOW]))
         self._dots[self._targets[0]].type = YELLOW
@@ -185,13 +327,10 @@ class Game():
     def _yellow_dot_too(self, append=True):
         ''' Things to reinitialize when starting up a new game. '''
         if append:
-            i = self._targets[0]
-            while i in self._targets:
-                i = int(uniform(0, NINE * FIVE))
-            self._targets.append(i)
+            self._new_target()
             self._lightbg.set_label(_('Well done! \
 Now tap on the other yellow dot.'))
-        self._next = self._yellow_dots_three
+        self._set_stage('yellow_dots_three')
         self._dots[self._targets[1]].set_shape(
             self._new_dot(self._colors[YELLOW]))
         self._dots[self._targets[1]].type = YELLOW
@@ -203,12 +342,9 @@ Now tap on the other yellow dot.'))
             self._yellow_dot_too(append=False)
             self._lightbg.set_label(_('The other yellow dot!'))
             return
-        i = self._targets[0]
-        while i in self._targets:
-            i = int(uniform(0, NINE * FIVE))
-        self._targets.append(i)
+        self._new_target()
         self._lightbg.set_label(_('Great! Now rub on one of the yellow dots.'))
-        self._next = self._red_dot
+        self._set_stage('red_dot')
         self._dots[self._targets[2]].set_shape(
             self._new_dot(self._colors[YELLOW]))
         self._dots[self._targets[2]].type = YELLOW
@@ -219,7 +355,7 @@ Now tap on the other yellow dot.'))
             return
         self._lightbg.set_label(_('Good job! \
 Now rub on another one of the yellow dots.'))
-        self._next = self._blue_dot
+        self._set_stage('blue_dot')
         self._dots[self._release].set_shape(self._new_dot(self._colors[RED]))
         self._dots[self._release].type = RED
         self._rubbing = True
@@ -231,7 +367,7 @@ Now rub on another one of the yellow dots.'))
             return
         self._lightbg.set_label(
             _('Now gently tap on the yellow dot five times.'))
-        self._next = self._yellow_tap
+        self._set_stage('yellow_tap')
         self._dots[self._release].set_shape(self._new_dot(self._colors[BLUE]))
         self._dots[self._release].type = BLUE
         self._rubbing = False
@@ -248,15 +384,12 @@ Now rub on another one of the yellow dots.'))
         self._count += 1
         if self._count > 4:
             self._count = 0
-            self._next = self._red_tap
+            self._set_stage('red_tap')
             self._lightbg.set_label(
                 _('Now gently tap on the red dot five times.'))
         else:
             self._lightbg.set_label(_('Keep tapping.'))
-        i = self._targets[0]
-        while i in self._targets:
-            i = int(uniform(0, NINE * FIVE))
-        self._targets.append(i)
+        i = self._new_target()
         self._dots[i].set_shape(self._new_dot(self._colors[YELLOW]))
         self._dots[i].type = YELLOW
 
@@ -271,15 +404,12 @@ Now rub on another one of the yellow dots.'))
         self._count += 1
         if self._count > 4:
             self._count = 0
-            self._next = self._blue_tap
+            self._set_stage('blue_tap')
             self._lightbg.set_label(
                 _('Now gently tap on the blue dot five times.'))
         else:
             self._lightbg.set_label(_('Keep tapping.'))
-        i = self._targets[0]
-        while i in self._targets:
-            i = int(uniform(0, NINE * FIVE))
-        self._targets.append(i)
+        i = self._new_target()
         self._dots[i].set_shape(self._new_dot(self._colors[RED]))
         self._dots[i].type = RED
 
@@ -294,54 +424,39 @@ Now rub on another one of the yellow dots.'))
         self._count += 1
         if self._count > 4:
             self._count = 0
-            self._next = self._shake_it
+            self._set_stage('shake_it')
             self._lightbg.set_label('')
-            # Since we don't end up in the button press
-            GObject.timeout_add(500, self._next)
         else:
             self._lightbg.set_label(_('Keep tapping.'))
-        i = self._targets[0]
-        while i in self._targets:
-            i = int(uniform(0, NINE * FIVE))
-        self._targets.append(i)
+        i = self._new_target()
         self._dots[i].set_shape(self._new_dot(self._colors[BLUE]))
         self._dots[i].type = BLUE
 
     def _shake_it(self):
         self._lightbg.set_label(_('OK. Now, shake the computer!!'))
-        for dot in self._dots:
-            if dot.type in [RED, YELLOW, BLUE]:
-                dot.set_layer(200)
-        self._next = self._shake_it_more
+        self._set_stage('shake_it_more')
         self._shake = 'random'
-        self._pausing = True
-        GObject.timeout_add(5000, self._clear_pause)
-        GObject.timeout_add(100, read_accelerometer, self)
+        self._start_motion()
 
     def _shake_it_more(self):
         self._lightbg.set_label(_('Shake it harder!!'))
-        self._next = self._turn_left
+        self._set_stage('turn_left')
         self._shake = 'random2'
-        self._pausing = True
-        GObject.timeout_add(5000, self._clear_pause)
 
     def _turn_left(self):
         self._lightbg.set_label(
             _('See what happens if you turn it to the left.'))
-        self._next = self._turn_right
+        self._set_stage('turn_right')
         self._shake = 'left'
-        self._pausing = True
 
     def _turn_right(self):
         self._lightbg.set_label(_('Now turn it to the right.'))
-        self._next = self._align
-        self._pausing = True
+        self._set_stage('align')
         self._shake = 'right'
 
     def _align(self):
         self._lightbg.set_label(_('Shake it some more.'))
-        self._next = self._tap_six
-        self._pausing = True
+        self._set_stage('tap_six')
         self._shake = 'align'
 
     def _tap_six(self):
@@ -349,80 +464,72 @@ Now rub on another one of the yellow dots.'))
         self._lightbg.set_label(_('OK. Now press each of the yellow dots.'))
         if self._tapped == None:
             self._tapped = []
-        if self._dots[self._release].type != YELLOW:
-            self._lightbg.set_label(_('Press the yellow dots.'))
+        if len(self._releases) == 0:  # arrived here from the physics
             return
-        else:
-            if not self._release in self._tapped:
-                self._tapped.append(self._release)
-                self._dots[self._release].set_label(':)')
+        for i in self._releases:
+            if self._dots[i].type != YELLOW:
+                self._lightbg.set_label(_('Press the yellow dots.'))
+            elif not i in self._tapped:
+                self._tapped.append(i)
+                self._dots[i].set_label(':)')
         if len(self._tapped) == 6:
-            self._darkbg.set_layer(100)
+            self._get_darkbg().set_layer(100)
             self._lightbg.set_layer(0)
-            for dot in self._dots:
-                if dot.type != YELLOW:
-                    dot.set_layer(0)
-            self._darkbg.set_label(_('Press all of the yellow dots again!'))
+            self._sprites.set_layers(
+                [dot for dot in self._dots if dot.type != YELLOW], 0)
+            self._get_darkbg().set_label(
+                _('Press all of the yellow dots again!'))
             self._tapped = None
-            self._next = self._tap_six_too
+            self._set_stage('tap_six_too')
 
     def _tap_six_too(self):
         self._shake = None
         if self._tapped == None:
             self._tapped = []
-        if self._dots[self._release].type != YELLOW:
-            return
-        else:
-            if not self._release in self._tapped:
-                self._tapped.append(self._release)
-                self._dots[self._release].set_label('')
+        for i in self._releases:
+            if self._dots[i].type == YELLOW and not i in self._tapped:
+                self._tapped.append(i)
+                self._dots[i].set_label('')
         if len(self._tapped) == 6:
             self._lightbg.set_layer(100)
-            self._darkbg.set_layer(0)
-            for dot in self._dots:
-                if dot.type in [RED, BLUE]:
-                    dot.set_layer(100)
-            pos1 = self._dots[self._targets[1]].get_xy()
-            pos2 = self._dots[self._targets[2]].get_xy()
-            self._dots[self._targets[1]].move(pos2)
-            self._dots[self._targets[2]].move(pos1)
+            self._get_darkbg().set_layer(0)
+            self._sprites.set_layers(
+                [dot for dot in self._dots if dot.type in [RED, BLUE]], 100)
+            self._swap_dots(self._dots[self._targets[1]],
+                            self._dots[self._targets[2]])
             self._lightbg.set_label(
                 _('Tap on the two dots that switched positions.'))
             self._tapped = None
-            self._next = self._tap_two
+            self._set_stage('tap_two')
 
     def _tap_two(self):
         self._shake = None
         if self._tapped == None:
             self._tapped = []
-        if not self._release in [self._targets[1], self._targets[2]]:
+        found = [i for i in self._releases
+                 if i in [self._targets[1], self._targets[2]]]
+        if len(found) == 0:
             self._lightbg.set_label(_('Keep trying.'))
             return
-        else:
-            if not self._release in self._tapped:
-                self._tapped.append(self._release)
-                self._dots[self._release].set_label(':)')
+        for i in found:
+            if not i in self._tapped:
+                self._tapped.append(i)
+                self._dots[i].set_label(':)')
         if len(self._tapped) == 2:
-            pos1 = self._dots[self._targets[1]].get_xy()
-            pos2 = self._dots[self._targets[2]].get_xy()
-            self._dots[self._targets[1]].move(pos2)
-            self._dots[self._targets[2]].move(pos1)
+            self._swap_dots(self._dots[self._targets[1]],
+                            self._dots[self._targets[2]])
             self._lightbg.set_label(_("Good job! Now let's shake again."))
             self._shake = 'random2'
-            self._next = self._shake_three
-            # Since we don't end up in the button press
-            GObject.timeout_add(500, self._next)
+            self._set_stage('shake_three')
             for i in self._tapped:
                 self._dots[i].set_label('')
         elif len(self._tapped) == 1:
             self._lightbg.set_label(_('You found one. Now find the other one.'))
 
     def _shake_three(self):
-        self._next = self._fade_it
+        self._set_stage('fade_it')
         self._shake = 'random2'
-        GObject.timeout_add(100, read_accelerometer, self)
-        self._pausing = True
-        GObject.timeout_add(2000, self._clear_pause)
+        self._start_motion()
 
     def _fade_it(self):
         for dot in self._dots:
@@ -430,9 +537,7 @@ Now rub on another one of the yellow dots.'))
                 self._fade_dot(dot, 1)
         self._lightbg.set_label(_('Going'))
         self._shake = 'random2'
-        self._next = self._fade_it_again
-        self._pausing = True
-        GObject.timeout_add(2000, self._clear_pause)
+        self._set_stage('fade_it_again')
 
     def _fade_it_again(self):
         for dot in self._dots:
@@ -440,9 +545,7 @@ Now rub on another one of the yellow dots.'))
                 self._fade_dot(dot, 2)
         self._lightbg.set_label(_('Going') + '..')
         self._shake = 'random2'
-        self._next = self._and_again
-        self._pausing = True
-        GObject.timeout_add(2000, self._clear_pause)
+        self._set_stage('and_again')
 
     def _and_again(self):
         for dot in self._dots:
@@ -450,9 +553,7 @@ Now rub on another one of the yellow dots.'))
                 self._fade_dot(dot, 3)
         self._lightbg.set_label(_('Going') + '...')
         self._shake = 'random2'
-        self._next = self._one_last_time
-        self._pausing = True
-        GObject.timeout_add(2000, self._clear_pause)
+        self._set_stage('one_last_time')
 
     def _one_last_time(self):
         for dot in self._dots:
@@ -460,8 +561,7 @@ Now rub on another one of the yellow dots.'))
                 self._fade_dot(dot, 4)
         self._lightbg.set_label(_('Gone!'))
         self._shake = None
-        self._next = self._yellow_dot
-        GObject.timeout_add(500, self._next)
+        self._set_stage('yellow_dot')
 
     def _fade_dot(self, dot, i):
         if i == 4:
@@ -474,113 +574,353 @@ Now rub on another one of the yellow dots.'))
         self._activity.status.set_label(string)
 
     def motion_cb(self, x, y, z):
-        if read_accelerometer.device_path is None:
+        if not self._motion.is_device:
             jiggle_factor = 5
         else:
             jiggle_factor = 3
         if self._shake is None:
+            self._stop_motion()
             return
-        elif self._shake in ['random', 'random2']:
-            if self._shake == 'random2':
-                jiggle_factor *= 2
-            for dot in self._dots:
-                if dot.type in [RED, YELLOW, BLUE]:
-                    x += int(uniform(-jiggle_factor, jiggle_factor))
-                    z += int(uniform(-jiggle_factor, jiggle_factor))
-                    # Randomize z drift, which tends toward up...
-                    if int(uniform(0, 2)) == 0:
-                        z = -z
-                    dot.move_relative((x, z))
+        if self._shake == 'random2':
+            jiggle_factor *= 2
+        if numpy is not None:
+            self._array_motion(x, z, jiggle_factor)
+        else:
+            self._loop_motion(x, z, jiggle_factor)
+        if not self._pausing:
+            if self._engine.current is not None:
+                self._engine.transition(1000)
+            else:
+                self._lightbg.set_label('')
+                self._shake = None
+        return
+
+    def _loop_motion(self, x, z, jiggle_factor):
+        ''' One physics step, one dot at a time (see _array_motion) '''
+        n = len(self._moving)
+        if n == 0:
+            return
+        if self._shake in ['random', 'random2']:
+            jx = self._draw(-jiggle_factor, jiggle_factor, n)
+            jz = self._draw(-jiggle_factor, jiggle_factor, n)
+            flip = self._draw(0, 2, n)
+            for i, dot in enumerate(self._moving):
+                x += jx[i]
+                z += jz[i]
+                # Randomize z drift, which tends toward up...
+                if flip[i] == 0:
+                    z = -z
+                self._nudge(dot, (x, z))
         elif self._shake == 'align':
+            jiggle = self._draw(-jiggle_factor, jiggle_factor, 2 * n)
             docked = True
             yellow = 0
             red = 0
             blue = 0
-            for dot in self._dots:
+            for i, dot in enumerate(self._moving):
+                shake = jiggle[2 * i:2 * i + 2]
                 if dot.type == YELLOW:
-                    docked = self._dock_dot(dot, yellow + 1, 1, jiggle_factor,
-                                            docked)
+                    docked = self._dock_dot(dot, yellow + 1, 1, shake, docked)
                     yellow += 1
                 elif dot.type == RED:
-                    docked = self._dock_dot(dot, red + 2, 2, jiggle_factor,
-                                            docked)
+                    docked = self._dock_dot(dot, red + 2, 2, shake, docked)
                     red += 1
                 elif dot.type == BLUE:
-                    docked = self._dock_dot(dot, blue + 3, 3, jiggle_factor,
-                                            docked)
+                    docked = self._dock_dot(dot, blue + 3, 3, shake, docked)
                     blue += 1
             if docked:
                 self._lightbg.set_label(_('Interesting.'))
                 self._pausing = False
-        elif self._shake == 'left':
-            right = False
-            for dot in self._dots:
-                if dot.type in [RED, YELLOW, BLUE]:
-                    pos = dot.get_xy()
-                    if pos[0] < 0:
-                        if pos[1] > self._height:
-                            z = int(uniform(-20, 0))
-                        elif pos[1] < 0:
-                            z = int(uniform(0, 20))
-                        x = int(uniform(0, 10))
-                        dot.move_relative((x, z))
-                    elif x < 0:
-                        x += int(uniform(-10, 0))
-                        if pos[1] > self._height:
-                            z = int(uniform(-20, 0))
-                        elif pos[1] < 0:
-                            z = int(uniform(0, 20))
-                        if pos[0] > -x:
-                            dot.move_relative((x, z))
-                    pos = dot.get_xy()
-                    if pos[0] > 100:
-                        right = True
-            if not right:
+        elif self._shake in ['left', 'right']:
+            # Dots off the edge come back; the others drift with the tilt,
+            # the drift growing from dot to dot, and each dot above or
+            # below the screen bounces back onto it.
+            edge = self._width - self._dot_size
+            if self._shake == 'left':
+                tilting = x < 0
+                back = self._draw(0, 10, n)
+                drift = self._draw(-10, 0, n)
+            else:
+                tilting = x < edge
+                back = self._draw(-10, 0, n)
+                drift = self._draw(0, 10, n)
+            up = self._draw(-20, 0, n)
+            down = self._draw(0, 20, n)
+            done = True
+            for i, dot in enumerate(self._moving):
+                x += drift[i]
+                pos = self._animator.target(dot)
+                if pos[1] > self._height:
+                    dz = up[i]
+                elif pos[1] < 0:
+                    dz = down[i]
+                else:
+                    dz = z
+                if self._shake == 'left':
+                    off = pos[0] < 0
+                    room = pos[0] > -x
+                else:
+                    off = pos[0] > edge
+                    room = pos[0] < edge - x
+                if off:
+                    self._nudge(dot, (back[i], dz))
+                elif tilting and room:
+                    self._nudge(dot, (x, dz))
+                pos = self._animator.target(dot)
+                if self._shake == 'left' and pos[0] > 100:
+                    done = False
+                elif self._shake == 'right' and pos[0] < edge - 100:
+                    done = False
+            if done:
                 self._lightbg.set_label(_('Hmm'))
                 self._pausing = False
-        elif self._shake == 'right':
-            left = False
-            for dot in self._dots:
-                if dot.type in [RED, YELLOW, BLUE]:
-                    pos = dot.get_xy()
-                    if pos[0] > self._width - self._dot_size:
-                        if pos[1] > self._height:
-                            z = int(uniform(-20, 0))
-                        elif pos[1] < 0:
-                            z = int(uniform(0, 20))
-                        x = int(uniform(-10, 0))
-                        dot.move_relative((x, z))
-                    elif x < self._width - self._dot_size:
-                        x += int(uniform(0, 10))
-                        if pos[1] > self._height:
-                            z = int(uniform(-20, 0))
-                        elif pos[1] < 0:
-                            z = int(uniform(0, 20))
-                        if pos[0] < self._width - x - self._dot_size:
-                            dot.move_relative((x, z))
-                    pos = dot.get_xy()
-                    if pos[0] < self._width - self._dot_size - 100:
-                        left = True
-            if not left:
-                self._lightbg.set_label(_('Hmm'))
+
+    def _gather_moving(self):
+        ''' Collect the colored dots (into arrays, for _array_motion) '''
+        self._moving = [dot for dot in self._dots
+                        if dot.type in [RED, YELLOW, BLUE]]
+        if numpy is None:
+            return
+        self._xy = numpy.array(
+            [self._animator.target(dot) for dot in self._moving],
+            dtype=int).reshape(-1, 2)
+        # Where each dot docks in the 'align' stage (see _dock_dot)
+        slots = {YELLOW: [1, 1], RED: [2, 2], BLUE: [3, 3]}
+        dock = []
+        for dot in self._moving:
+            dock.append([slots[dot.type][0], slots[dot.type][1]])
+            slots[dot.type][0] += 1
+        self._dock = numpy.array(dock, dtype=int).reshape(-1, 2) * \
+            (self._dot_size + self._space)
+
+    def _draw(self, low, high, n):
+        ''' n random integers, truncated toward zero like int(uniform());
+        both physics paths take the same draws, in the same order '''
+        uniform = self._physics_random.uniform
+        return [int(uniform(low, high)) for i in xrange(n)]
+
+    def _jiggle(self, low, high, shape):
+        ''' _draw, as an array of the given shape '''
+        count = shape if isinstance(shape, int) else shape[0] * shape[1]
+        return numpy.array(self._draw(low, high, count),
+                           dtype=int).reshape(shape)
+
+    def _bounce(self, y, z):
+        ''' Vertical drift, which pushes dots back onto the screen '''
+        n = len(y)
+        up = self._jiggle(-20, 0, n)
+        down = self._jiggle(0, 20, n)
+        return numpy.where(y > self._height, up,
+                           numpy.where(y < 0, down, z))
+
+    def _array_motion(self, x, z, jiggle_factor):
+        ''' One physics step for all of the moving dots at once '''
+        n = len(self._moving)
+        if n == 0:
+            return
+        xy = self._xy
+        old = xy.copy()
+        if self._shake in ['random', 'random2']:
+            # The jiggle accumulates from dot to dot and the vertical
+            # drift changes sign at random, as in _loop_motion.
+            dx = x + numpy.cumsum(self._jiggle(-jiggle_factor, jiggle_factor,
+                                               n))
+            jz = self._jiggle(-jiggle_factor, jiggle_factor, n)
+            sign = numpy.where(self._jiggle(0, 2, n) == 0, -1, 1)
+            flips = numpy.cumprod(sign)
+            before = numpy.concatenate(([1], flips[:-1]))
+            dz = flips * (z + numpy.cumsum(before * jz))
+            xy += numpy.column_stack((dx, dz))
+        elif self._shake == 'align':
+            delta = self._dock - xy
+            close = numpy.all(numpy.abs(delta) < 11, axis=1)
+            step = numpy.clip(delta, -10, 10) + \
+                self._jiggle(-jiggle_factor, jiggle_factor, (n, 2))
+            xy[:] = numpy.where(close[:, None], self._dock, xy + step)
+            if numpy.all(close):
+                self._lightbg.set_label(_('Interesting.'))
                 self._pausing = False
-        if not self._pausing:
-            if self._next is not None:
-                GObject.timeout_add(1000, self._next)
+        elif self._shake in ['left', 'right']:
+            if self._shake == 'left':
+                off = xy[:, 0] < 0
+                tilting = x < 0
+                back = self._jiggle(0, 10, n)
+                drift = x + numpy.cumsum(self._jiggle(-10, 0, n))
+                room = xy[:, 0] > -drift
             else:
-                self._lightbg.set_label('')
-                self._shake = None
-        GObject.timeout_add(100, read_accelerometer, self)
-        return
+                edge = self._width - self._dot_size
+                off = xy[:, 0] > edge
+                tilting = x < edge
+                back = self._jiggle(-10, 0, n)
+                drift = x + numpy.cumsum(self._jiggle(0, 10, n))
+                room = xy[:, 0] < edge - drift
+            dz = self._bounce(xy[:, 1], z)
+            move = off | (tilting & room)
+            dx = numpy.where(off, back, drift)
+            xy += numpy.column_stack((dx, dz)) * move[:, None]
+            if self._shake == 'left':
+                done = not numpy.any(xy[:, 0] > 100)
+            else:
+                done = not numpy.any(xy[:, 0] < edge - 100)
+            if done:
+                self._lightbg.set_label(_('Hmm'))
+                self._pausing = False
+        # Hand the new positions to the sprites in a single pass.
+        for i in numpy.flatnonzero(numpy.any(xy != old, axis=1)):
+            self._animator.glide(self._moving[i], (int(xy[i, 0]),
+                                                   int(xy[i, 1])))
+
+    def _start_motion(self):
+        ''' Start reading the motion source and running the physics '''
+        self._gather_moving()
+        # Only the colored dots move: raise them above everything else,
+        # which can then be drawn from a single cached surface.
+        self._sprites.set_layers(self._moving, 200)
+        self._sprites.set_static_layer(
+            100, (int(round(self._width)), int(round(self._height))))
+        self._motion.start()
+        self._animator.start_steps(self._physics_step)
+
+    def _stop_motion(self):
+        ''' Stop the physics and let the motion source rest '''
+        self._animator.stop_steps()
+        self._motion.stop()
+        self._sprites.set_static_layer(None)
+
+    def stop(self):
+        ''' Release resources when the activity is closing '''
+        self._stop_motion()
+        self._engine.cancel_all()
+        if self._rub is not None:
+            self._rub.end()
+        if self._touch_id is not None:
+            GObject.source_remove(self._touch_id)
+            self._touch_id = None
+        if self._prewarm_id is not None:
+            GObject.source_remove(self._prewarm_id)
+            self._prewarm_id = None
+        if self._sprites.stats is not None:
+            self._sprites.stats.save(self._stats_path)
+
+    def get_snapshot(self):
+        ''' The state of the game, as a dictionary that can be saved as
+        JSON and handed back to restore_snapshot '''
+        colors = {}
+        for color, region in self._atlas_regions.items():
+            colors[region] = color
+        dots = []
+        for dot in self._dots:
+            x, y = self._animator.target(dot)
+            dots.append([dot.type, x, y, colors.get(dot.images[0]),
+                         dot.layer, _get_label(dot)])
+        backgrounds = [[self._lightbg.layer, _get_label(self._lightbg)]]
+        if self._darkbg is not None:
+            backgrounds.append([self._darkbg.layer,
+                                _get_label(self._darkbg)])
+        return {'version': SNAPSHOT_VERSION,
+                'grid': [self._columns, self._rows],
+                'stage': self._engine.current,
+                'targets': self._targets,
+                'tapped': self._tapped,
+                'count': self._count,
+                'release': self._release,
+                'rubbing': self._rubbing,
+                'pausing': self._pausing,
+                'shake': self._shake,
+                'backgrounds': backgrounds,
+                'dots': dots}
+
+    def restore_snapshot(self, snapshot):
+        ''' Put the game back in the state described by a snapshot from
+        get_snapshot, without replaying the stages that led there.
+        Return False if the snapshot does not fit this game. '''
+        if not isinstance(snapshot, dict):
+            return False
+        for key in SNAPSHOT_KEYS:
+            if key not in snapshot:
+                return False
+        if snapshot['version'] != SNAPSHOT_VERSION or \
+                snapshot['grid'] != [self._columns, self._rows] or \
+                snapshot['stage'] not in STAGES or \
+                len(snapshot['dots']) != len(self._dots) or \
+                len(snapshot['backgrounds']) not in [1, 2]:
+            return False
+        for dot in snapshot['dots']:
+            if len(dot) != 6:
+                return False
+        for background in snapshot['backgrounds']:
+            if len(background) != 2:
+                return False
+        self._stop_motion()
+        self._engine.cancel_all()
+        self._targets = snapshot['targets']
+        self._tapped = snapshot['tapped']
+        self._count = snapshot['count']
+        self._rubbing = snapshot['rubbing']
+        self._shake = snapshot['shake']
+        self._release = snapshot['release']
+
+        # The backgrounds go first: a sprite put on a layer goes on top
+        # of the ones already there, and the dots must be above them.
+        backgrounds = snapshot['backgrounds']
+        self._lightbg.set_layer(backgrounds[0][0])
+        _set_label(self._lightbg, backgrounds[0][1])
+        if len(backgrounds) > 1:
+            self._get_darkbg().set_layer(backgrounds[1][0])
+            _set_label(self._darkbg, backgrounds[1][1])
+        elif self._darkbg is not None:
+            self._darkbg.set_layer(0)
 
-    def _dock_dot(self, dot, n, m, jiggle_factor, docked):
+        layers = {}
+        for dot, (type, x, y, color, layer, label) in zip(
+                self._dots, snapshot['dots']):
+            self._animator.cancel(dot)
+            dot.move((x, y))
+            if color is None:
+                color = self._colors[WHITE]
+            dot.set_shape(self._new_dot(color))
+            dot.type = type
+            _set_label(dot, label)
+            layers.setdefault(layer, []).append(dot)
+        for layer in sorted(layers):
+            self._sprites.set_layers(layers[layer], layer)
+
+        self._set_stage(snapshot['stage'])
+        # Entering a stage may pause it, for the physics to clear; the
+        # snapshot says whether that had happened.
+        self._pausing = snapshot['pausing']
+        if self._release is not None:
+            self._releases.append(self._release)
+        if self._shake is not None:
+            self._start_motion()
+        return True
+
+    def _physics_step(self):
+        ''' Called by the animator once every PHYSICS_STEP '''
+        x, y, z = self._motion.read()
+        self.motion_cb(x, y, z)
+
+    def _nudge(self, dot, delta):
+        ''' Glide a dot by (dx, dy) from where it is heading '''
+        pos = self._animator.target(dot)
+        self._animator.glide(dot, (pos[0] + int(delta[0]),
+                                   pos[1] + int(delta[1])))
+
+    def _swap_dots(self, dot1, dot2):
+        ''' Slide two dots into each other's places '''
+        pos1 = self._animator.target(dot1)
+        pos2 = self._animator.target(dot2)
+        self._animator.animate_to(dot1, pos2, SWAP_TIME)
+        self._animator.animate_to(dot2, pos1, SWAP_TIME)
+
+    def _dock_dot(self, dot, n, m, jiggle, docked):
         x = (self._dot_size + self._space) * n
         y = (self._dot_size + self._space) * m
-        pos = dot.get_xy()
+        pos = self._animator.target(dot)
         dx = x - pos[0]
         dy = y - pos[1]
         if abs(dx) < 11 and abs(dy) < 11:
-            dot.move((x, y))
+            self._animator.glide(dot, (x, y))
             return docked
         else:
             if dx < 0:
@@ -591,9 +931,9 @@ Now rub on another one of the yellow dots.'))
                 dy = max(-10, dy)
             elif dy > 0:
                 dy = min(10, dy)
-            dx += int(uniform(-jiggle_factor, jiggle_factor))
-            dy += int(uniform(-jiggle_factor, jiggle_factor))
-            dot.move_relative((dx, dy))
+            dx += jiggle[0]
+            dy += jiggle[1]
+            self._nudge(dot, (dx, dy))
             return False
 
     def _button_press_cb(self, win, event):
@@ -602,7 +942,8 @@ Now rub on another one of the yellow dots.'))
         win.grab_focus()
         x, y = map(int, event.get_coords())
         self._press = True
-        self._release = None
+        if not self._engine.transition_pending():  # else, taps are queued
+            self._release = None
 
         spr = self._sprites.find_sprite((x, y))
         if spr == None:
@@ -611,18 +952,29 @@ Now rub on another one of the yellow dots.'))
         self.last_spr = spr
         if self._rubbing:
             self._pausing = True
-            if spr in self._dots:
-                for target in self._targets:
-                    if self._dots.index(spr) == target:
-                        self._release = target
-            GObject.timeout_add(1000, self._clear_pause)
+            if getattr(spr, 'dot_index', None) in self._targets:
+                self._release = spr.dot_index
+            if self._rub is not None:
+                self._rub.begin(spr, x, y)
+                return True
+            if self._rub_timer is not None:
+                self._engine.source_remove(self._rub_timer)
+            self._rub_timer = self._engine.timeout_add(1000,
+                                                       self._clear_pause)
         return True
 
+    def _rubbed(self, spr):
+        ''' The recognizer saw spr being rubbed '''
+        self._clear_pause()
+
     def _button_release_cb(self, win, event):
         if self._shake is not None:
             return True
+        if self._rub is not None:
+            self._rub.end()
         self._press = False
-        self._release = None
+        if not self._engine.transition_pending():  # else, taps are queued
+            self._release = None
 
         if self._pausing:
             self._lightbg.set_label(_('Rub a little longer.'))
@@ -630,55 +982,291 @@ Now rub on another one of the yellow dots.'))
 
         x, y = map(int, event.get_coords())
         spr = self._sprites.find_sprite((x, y))
-        if spr.type is not None:
-            if spr in self._dots:
-                for target in self._targets:
-                    if self._dots.index(spr) == target:
-                        self._release = target
-                        if self._next is not None:
-                            GObject.timeout_add(200, self._next)
+        if spr is not None and spr.type is not None:
+            if getattr(spr, 'dot_index', None) in self._targets:
+                self._tap([spr.dot_index])
+
+    def _tap(self, dots):
+        ''' Hand the stage the dots tapped; taps that come before it gets
+        to them are handed over together '''
+        if self._engine.transition(200):
+            self._releases = []
+        for i in dots:
+            if not i in self._releases:
+                self._releases.append(i)
+        self._release = self._releases[-1]
+
+    def _touch_cb(self, win, event):
+        ''' Keep track of the touches beyond the first: the first one is
+        also seen as the pointer, and handled by the button callbacks '''
+        if event.emulating_pointer:
+            return False
+        touch = self._touches.get(event.sequence)
+        if event.type == Gdk.EventType.TOUCH_BEGIN:
+            self._touches[event.sequence] = [event.x, event.y, None,
+                                             False, False]
+        elif touch is None:
+            return False
+        elif event.type == Gdk.EventType.TOUCH_CANCEL:
+            del self._touches[event.sequence]
+            return False
+        else:
+            touch[0] = event.x
+            touch[1] = event.y
+            if event.type == Gdk.EventType.TOUCH_END:
+                touch[4] = True
+        # Hit test the touches together, once the events queued for this
+        # frame are all in.
+        if self._touch_id is None:
+            self._touch_id = GObject.idle_add(
+                self._touch_frame, priority=GObject.PRIORITY_HIGH_IDLE)
+        return False
+
+    def _touch_frame(self):
+        ''' Find the dots under the touches that began, and tap the ones
+        under the touches that ended where they began '''
+        self._touch_id = None
+        tapped = []
+        for sequence, touch in self._touches.items():
+            x, y, spr, seen, ended = touch
+            if not seen:  # (a quick tap may begin and end in one frame)
+                spr = touch[2] = self._sprites.find_sprite((x, y))
+                touch[3] = True
+            if ended:
+                del self._touches[sequence]
+                if spr is not None and \
+                        spr is self._sprites.find_sprite((x, y)) and \
+                        getattr(spr, 'dot_index', None) in self._targets:
+                    tapped.append(spr.dot_index)
+        if len(tapped) > 0 and self._shake is None and not self._pausing:
+            self._tap(tapped)
+        return False
 
     def _smile(self):
         for dot in self._dots:
             dot.set_label(':)')
 
     def __draw_cb(self, canvas, cr):
-        self._sprites.redraw_sprites(cr=cr)
+        self._redraw(cr)
+
+    def _redraw(self, cr):
+        ''' Draw the sprites in the clip region of cr, timing it if asked '''
+        stats = self._sprites.stats
+        if stats is None:
+            self._sprites.redraw_sprites(cr=cr)
+        else:
+            start = stats.clock()
+            self._sprites.redraw_sprites(cr=cr)
+            stats.record('draw', start)
+
+    def render_frame(self, full=False):
+        ''' Draw the scene into an offscreen cairo.ImageSurface and return
+        it. Only the regions invalidated since the last frame are redrawn
+        unless full is True. The surface is reused from frame to frame,
+        so copy it (or write_to_png) if you need to keep it. '''
+        damage = self._sprites.take_damage()
+        if self._frame is None:
+            self._frame = cairo.ImageSurface(
+                cairo.FORMAT_RGB24, int(round(self._width)),
+                int(round(self._height)))
+            full = True
+        cr = cairo.Context(self._frame)
+        if not full:
+            if len(damage) == 0:
+                return self._frame
+            for x, y, w, h in damage:
+                cr.rectangle(x, y, w, h)
+            cr.clip()
+        self._redraw(cr)
+        return self._frame
 
     def _grid_to_dot(self, pos):
         ''' calculate the dot index from a column and row in the grid '''
-        return pos[0] + pos[1] * NINE
+        return pos[0] + pos[1] * self._columns
 
     def _dot_to_grid(self, dot):
         ''' calculate the grid column and row for a dot '''
-        return [dot % NINE, int(dot / NINE)]
+        return [dot % self._columns, int(dot / self._columns)]
 
     def _destroy_cb(self, win, event):
         Gtk.main_quit()
 
+    def _prewarm_dots(self):
+        ''' Rasterize the dots the first frame needs now, and the rest of
+        the palette (the fade shades) once the main loop is idle '''
+        self._new_dot(self._colors[WHITE])
+        self._new_dot(self._colors[YELLOW])
+        if self._canvas is not None and (len(self._atlas_pending) > 0 or
+                                         len(self._atlas_unmasked) > 0):
+            self._prewarm_id = GObject.idle_add(self._prewarm_idle)
+
+    def _prewarm_idle(self):
+        ''' Rasterize one more shade of dot, or (for an atlas read from
+        the disk cache) make the hit-test mask of one '''
+        if len(self._atlas_pending) > 0:
+            self._new_dot(self._atlas_pending[0])
+        elif len(self._atlas_unmasked) > 0:
+            self._sprites.get_mask(
+                self._atlas_regions[self._atlas_unmasked.pop()])
+        if len(self._atlas_pending) > 0 or len(self._atlas_unmasked) > 0:
+            return True
+        self._prewarm_id = None
+        return False
+
     def _new_dot(self, color):
         ''' generate a dot of a color color '''
-        self._dot_cache = {}
-        if not color in self._dot_cache:
-            self._stroke = color
-            self._fill = color
-            self._svg_width = self._dot_size
-            self._svg_height = self._dot_size
+        if self._atlas is None:
+            self._build_atlas()
+        if color not in self._atlas_regions:  # not in the palette
+            self._add_region(color)
+        if color in self._atlas_pending:
+            self.dot_cache_misses += 1
+            self._draw_dot(color)
+        else:
+            self.dot_cache_hits += 1
+        return self._atlas_regions[color]
+
+    def _build_atlas(self):
+        ''' Make room for every shade of dot in a single surface, a grid
+        of ATLAS_COLUMNS dots across, or map it in from the disk cache.
+        Shades are drawn into it as they are first needed. '''
+        colors = []
+        for color in self._colors:
+            if color not in colors:
+                colors.append(color)
+        rows = (len(colors) + ATLAS_COLUMNS - 1) / ATLAS_COLUMNS
+        width = ATLAS_COLUMNS * self._dot_size
+        height = rows * self._dot_size
+        for region in self._atlas_regions.values():
+            self._sprites.forget_mask(region)
+        self._atlas_regions = {}
+        self._atlas_pending = []
+        self._atlas_unmasked = []
+        self._atlas = self._load_asset('dots', cairo.FORMAT_ARGB32, width,
+                                       height)
+        self._atlas_saved = self._atlas is not None
+        if self._atlas is None:
+            self._atlas = self._sprites.create_surface(width, height)
+        for color in colors:
+            self._add_region(color)
+        if self._atlas_saved:  # every shade is already drawn...
+            self._atlas_unmasked = self._atlas_pending  # ...but not masked
+            self._atlas_pending = []
+
+    def _add_region(self, color):
+        ''' Give the next cell of the atlas to color '''
+        i = len(self._atlas_regions)
+        region = AtlasRegion(self._atlas,
+                             (i % ATLAS_COLUMNS) * self._dot_size,
+                             (i / ATLAS_COLUMNS) * self._dot_size,
+                             self._dot_size, self._dot_size)
+        if region.y + region.height > \
+                self._atlas.get_height() / self._device_scale:
+            # Out of room: copy the atlas into a taller one.
+            atlas = self._sprites.create_surface(
+                ATLAS_COLUMNS * self._dot_size, region.y + region.height)
+            context = cairo.Context(atlas)
+            context.set_source_surface(self._atlas, 0, 0)
+            context.paint()
+            self._atlas = atlas
+            for other in self._atlas_regions.values():
+                other.surface = atlas
+            region.surface = atlas
+        self._atlas_regions[color] = region
+        self._atlas_pending.append(color)
+        return region
+
+    def _draw_dot(self, color):
+        ''' Draw a dot of color into its cell of the atlas '''
+        region = self._atlas_regions[color]
+        context = cairo.Context(self._atlas)
+        context.translate(region.x, region.y)
+        context.rectangle(0, 0, region.width, region.height)
+        context.clip()
+        if self._renderer == CAIRO_RENDERER:
+            self._cairo_dot(context, color)
+        else:
+            self._svg_dot(context, color)
+        self._atlas_pending.remove(color)
+        # The dots are hit tested by shape: make the mask now, rather than
+        # on the first tap.
+        self._sprites.get_mask(region)
+        if len(self._atlas_pending) == 0 and not self._atlas_saved:
+            self._save_asset('dots', self._atlas)
+            self._atlas_saved = True
+
+    def _svg_dot(self, context, color):
+        ''' Rasterize a dot through librsvg '''
+        # Rasterize at the device resolution, not the logical one.
+        size = self._dot_size * self._device_scale
+        self._stroke = color
+        self._fill = color
+        self._svg_width = size
+        self._svg_height = size
+        pixbuf = svg_str_to_pixbuf(
+            self._header() + \
+            self._circle(size / 2., size / 2., size / 2.) + \
+            self._footer())
+        context.scale(1. / self._device_scale, 1. / self._device_scale)
+        Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
+        context.paint()
+
+    def _cairo_dot(self, context, color):
+        ''' Draw a dot with cairo, matching the geometry of _circle '''
+        context.set_source_rgb(*hex_to_rgb(color))
+        # The SVG circle is inset by half a pixel and stroked 1px wide.
+        context.arc(self._dot_size / 2., self._dot_size / 2.,
+                    self._dot_size / 2. - 0.5, 0, 2 * pi)
+        context.fill_preserve()
+        context.set_line_width(1)
+        context.stroke()
+
+    def _new_background(self, color):
+        ''' generate a full-screen background of a color color '''
+        width = int(round(self._width))
+        height = int(round(self._height))
+        name = 'bg-' + color[1:].lower()
+        surface = self._load_asset(name, cairo.FORMAT_RGB24, width, height)
+        if surface is not None:
+            return surface
+        surface = self._sprites.create_surface(width, height, opaque=True)
+        context = cairo.Context(surface)
+        if self._renderer == CAIRO_RENDERER:
+            context.set_source_rgb(*hex_to_rgb(color))
+            context.paint()
+        else:
+            # Whole pixels, as painted by cairo: the screen height is often
+            # fractional, and SVG would leave the last row partly covered.
+            self._svg_width = width
+            self._svg_height = height
             pixbuf = svg_str_to_pixbuf(
                 self._header() + \
-                self._circle(self._dot_size / 2., self._dot_size / 2.,
-                             self._dot_size / 2.) + \
+                self._rect(width, height, 0, 0, color=color) + \
                 self._footer())
-
-            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                         self._svg_width, self._svg_height)
-            context = cairo.Context(surface)
             Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
-            context.rectangle(0, 0, self._svg_width, self._svg_height)
-            context.fill()
-            self._dot_cache[color] = surface
-
-        return self._dot_cache[color]
+            context.paint()
+        self._save_asset(name, surface)
+        return surface
+
+    def _load_asset(self, name, format, width, height):
+        ''' Look for a rasterized asset (width x height logical pixels)
+        in the on-disk cache '''
+        if self._asset_cache is None:
+            return None
+        scale = self._device_scale
+        if scale != 1 and not hasattr(cairo.ImageSurface,
+                                      'set_device_scale'):
+            return None  # it could not be drawn at the right size
+        surface = self._asset_cache.load(name, format, width * scale,
+                                         height * scale)
+        if surface is not None and scale != 1:
+            surface.set_device_scale(scale, scale)
+        return surface
+
+    def _save_asset(self, name, surface):
+        ''' Store a rasterized asset in the on-disk cache '''
+        if self._asset_cache is not None:
+            self._asset_cache.save(name, surface)
 
     def _line(self, vertical=True):
         ''' Generate a center line '''
@@ -724,6 +1312,28 @@ Now rub on another one of the yellow dots.'))
         return '</svg>\n'
 
 
+def hex_to_rgb(color):
+    ''' Convert from '#RRGGBB' to floats '''
+    return (int(color[1:3], 16) / 255.,
+            int(color[3:5], 16) / 255.,
+            int(color[5:7], 16) / 255.)
+
+
+def _get_label(spr):
+    ''' The (first) label of a sprite, or None '''
+    if len(spr.labels) == 0:
+        return None
+    return spr.labels[0]
+
+
+def _set_label(spr, label):
+    ''' Set (or clear) the label of a sprite '''
+    if label is not None:
+        spr.set_label(label)
+    elif len(spr.labels) > 0:
+        spr.set_label('')
+
+
 def svg_str_to_pixbuf(svg_string):
     try:
         pl = GdkPixbuf.PixbufLoader.new_with_type('svg')
@@ -0,0 +1,183 @@
+#Copyright (c) 2026 Yellow Dot contributors
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+
+gestures.py recognizes rubbing: a stroke that goes back and forth over
+a sprite.
+
+The recognizer listens to pointer and touch motion, but an event only
+records where the pointer is; nothing is allocated or computed per
+event. Once per frame the latest position is looked up in the sprite
+hit index and, if it is still over the sprite being rubbed, the stroke
+length (in sprite widths) and any reversals of direction are added to
+its energy. Energy drains away while the stroke rests; the callback is
+called when it reaches the threshold.
+
+Example usage:
+        rub = RubRecognizer(sprites, rubbed_cb)
+        rub.attach(canvas)
+        ...
+        rub.begin(spr, x, y)  # on button press
+        rub.end()  # on button release
+
+'''
+
+from gi.repository import Gdk, GObject
+import time
+
+from animation import FALLBACK_INTERVAL, MAX_FRAME_TIME
+
+RUB_ENERGY = 4.  # energy at which a stroke counts as a rub
+REVERSAL_ENERGY = 0.5  # energy added by each change of direction
+HALF_LIFE = 1.  # seconds for the energy to drain by half
+JITTER = 2  # movements (in pixels) smaller than this are ignored
+
+
+class RubRecognizer:
+    ''' Turns strokes back and forth over a sprite into rubs '''
+
+    def __init__(self, sprites, callback, threshold=RUB_ENERGY):
+        self._sprites = sprites
+        self._callback = callback  # called with the sprite rubbed
+        self.threshold = threshold
+        self.energy = 0.
+        self._widget = None
+        self._target = None
+        self._x = 0.  # the latest position reported...
+        self._y = 0.
+        self._moved = False  # ...and whether it has been looked at
+        self._last_x = None  # the position at the last frame
+        self._last_y = 0.
+        self._dir_x = 0  # the direction of the stroke on each axis
+        self._dir_y = 0
+        self._last = None
+        self._tick_id = None
+        self._timeout_id = None
+
+    def attach(self, widget):
+        ''' Listen to the pointer and touch motion on a widget '''
+        self._widget = widget
+        widget.add_events(Gdk.EventMask.POINTER_MOTION_MASK |
+                          Gdk.EventMask.BUTTON_MOTION_MASK |
+                          Gdk.EventMask.TOUCH_MASK)
+        widget.connect('motion-notify-event', self._motion_cb)
+        widget.connect('touch-event', self._touch_cb)
+
+    def begin(self, sprite, x, y):
+        ''' Start a stroke at (x, y), rubbing sprite '''
+        self._target = sprite
+        self.energy = 0.
+        self._x, self._y = x, y
+        self._moved = False
+        self._last_x, self._last_y = x, y
+        self._dir_x, self._dir_y = 0, 0
+        self._start_ticking()
+
+    def end(self):
+        ''' The stroke is over, rub or not '''
+        self._target = None
+        self._stop_ticking()
+
+    def motion(self, x, y):
+        ''' Note where the pointer is; it is looked at once per frame '''
+        if self._target is not None:
+            self._x = x
+            self._y = y
+            self._moved = True
+
+    def _motion_cb(self, widget, event):
+        self.motion(event.x, event.y)
+        return False
+
+    def _touch_cb(self, widget, event):
+        # Only the touch that drives the pointer rubs. Returning False
+        # lets it also reach the button handlers.
+        if event.type == Gdk.EventType.TOUCH_UPDATE and \
+                event.emulating_pointer:
+            self.motion(event.x, event.y)
+        return False
+
+    def advance(self, now):
+        ''' Take in the motion since the last frame (now is in seconds).
+        Return False once the stroke is over. '''
+        if self._target is None:
+            return False
+        if self._last is not None:
+            self.energy *= 0.5 ** (min(now - self._last, MAX_FRAME_TIME) /
+                                   HALF_LIFE)
+        self._last = now
+        if self._moved:
+            self._moved = False
+            if self._sprites.find_sprite((self._x, self._y)) is \
+                    self._target:
+                self._stroke()
+            else:  # off the sprite: start afresh when back on it
+                self._last_x = None
+        if self.energy >= self.threshold:
+            target = self._target
+            self._target = None  # the frame ticks stop with this one
+            self._callback(target)
+            return False
+        return True
+
+    def _stroke(self):
+        ''' Add the movement to (self._x, self._y) to the energy '''
+        if self._last_x is None:
+            self._last_x, self._last_y = self._x, self._y
+            return
+        dx = self._x - self._last_x
+        dy = self._y - self._last_y
+        if abs(dx) < JITTER and abs(dy) < JITTER:
+            return
+        self._last_x, self._last_y = self._x, self._y
+        self.energy += (dx * dx + dy * dy) ** 0.5 / \
+            max(1, self._target.rect[2])
+        if abs(dx) >= JITTER:
+            if dx * self._dir_x < 0:
+                self.energy += REVERSAL_ENERGY
+            self._dir_x = 1 if dx > 0 else -1
+        if abs(dy) >= JITTER:
+            if dy * self._dir_y < 0:
+                self.energy += REVERSAL_ENERGY
+            self._dir_y = 1 if dy > 0 else -1
+
+    def _start_ticking(self):
+        if self._tick_id is not None or self._timeout_id is not None:
+            return
+        self._last = None
+        if self._widget is not None and \
+                hasattr(self._widget, 'add_tick_callback'):
+            self._tick_id = self._widget.add_tick_callback(self._tick)
+        else:
+            self._timeout_id = GObject.timeout_add(FALLBACK_INTERVAL,
+                                                   self._tick)
+
+    def _stop_ticking(self):
+        if self._tick_id is not None:
+            self._widget.remove_tick_callback(self._tick_id)
+            self._tick_id = None
+        if self._timeout_id is not None:
+            GObject.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+    def _tick(self, widget=None, frame_clock=None):
+        if frame_clock is not None:
+            now = frame_clock.get_frame_time() / 1000000.
+        else:
+            now = time.time()
+        alive = self.advance(now)
+        # A rub changes the scene from inside the frame clock: draw it now.
+        self._sprites.flush()
+        if alive:
+            return True
+        self._tick_id = None
+        self._timeout_id = None
+        return False
@@ -0,0 +1,171 @@
+#Copyright (c) 2026 Yellow Dot contributors
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+
+instrument.py collects drawing statistics: latency histograms for the
+draw callback and for labels, and counts of the sprites drawn and
+skipped, pixels blitted and labels laid out.
+
+It is off unless a DrawStats is attached to a Sprites collection
+(Sprites.stats), and the code it instruments only checks for None when
+it is off. Game turns it on when given a path to write the statistics
+to (the activity reads YELLOW_DOT_STATS from the environment).
+
+Histograms are log-linear, in the manner of HdrHistogram: values (in
+microseconds) below SUB_BUCKETS are counted exactly, larger ones in
+buckets that are never more than 1 / HALF_BUCKETS of their value wide.
+
+Example usage:
+        stats = DrawStats()
+        sprites.stats = stats
+        ...
+        stats.save('/tmp/draw-stats.json')
+
+'''
+
+import json
+import time
+
+import logging
+_logger = logging.getLogger('click-activity')
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS  # values counted exactly
+HALF_BUCKETS = SUB_BUCKETS >> 1  # buckets per power of two above that
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+def bucket_index(value):
+    ''' The histogram bucket holding an integer value '''
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKETS + (shift - 1) * HALF_BUCKETS + \
+        (value >> shift) - HALF_BUCKETS
+
+
+def bucket_range(index):
+    ''' The lowest and highest values counted in a bucket '''
+    if index < SUB_BUCKETS:
+        return (index, index)
+    shift = (index - SUB_BUCKETS) / HALF_BUCKETS + 1
+    mantissa = (index - SUB_BUCKETS) % HALF_BUCKETS + HALF_BUCKETS
+    return (mantissa << shift, ((mantissa + 1) << shift) - 1)
+
+
+class Histogram:
+    ''' A log-linear histogram of non-negative integers '''
+
+    def __init__(self):
+        self.counts = {}  # bucket index --> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            value = 0
+        i = bucket_index(value)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        ''' The highest value of the bucket holding the pth percentile '''
+        if self.count == 0:
+            return None
+        rank = max(1, int(round(self.count * p / 100.)))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(bucket_range(i)[1], self.max)
+        return self.max
+
+    def to_dict(self):
+        result = {'count': self.count, 'min': self.min, 'max': self.max,
+                  'mean': None, 'buckets': []}
+        if self.count > 0:
+            result['mean'] = self.total / float(self.count)
+        for p in PERCENTILES:
+            result['p%s' % (p)] = self.percentile(p)
+        for i in sorted(self.counts):
+            low, high = bucket_range(i)
+            result['buckets'].append([low, high, self.counts[i]])
+        return result
+
+
+class DrawStats:
+    ''' Timings and counts for the sprites of a canvas '''
+
+    def __init__(self):
+        self.histograms = {'draw': Histogram(),  # whole draw callbacks
+                           'label': Histogram()}  # draw_label calls
+        self.counters = {'frames': 0,
+                         'sprites_drawn': 0,
+                         'sprites_skipped': 0,
+                         'pixels_blitted': 0,
+                         'labels_laid_out': 0}
+        self._started = time.time()
+
+    def clock(self):
+        return time.time()
+
+    def record(self, name, start):
+        ''' Record the microseconds since start (from clock) '''
+        self.histograms[name].record((time.time() - start) * 1000000)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def sprite_drawn(self, spr, rect):
+        ''' Count a sprite drawn, and the pixels of it inside rect '''
+        self.counters['sprites_drawn'] += 1
+        w = min(spr.rect[0] + spr.rect[2], rect[0] + rect[2]) - \
+            max(spr.rect[0], rect[0])
+        h = min(spr.rect[1] + spr.rect[3], rect[1] + rect[3]) - \
+            max(spr.rect[1], rect[1])
+        if w > 0 and h > 0:
+            self.counters['pixels_blitted'] += int(w * h) * len(spr.images)
+
+    def frame_done(self, sprites, drawn):
+        ''' Count a redraw of sprites sprites, drawn of which were drawn '''
+        self.counters['frames'] += 1
+        self.counters['sprites_skipped'] += sprites - drawn
+
+    def to_dict(self):
+        result = {'seconds': time.time() - self._started,
+                  'unit': 'us',
+                  'counters': dict(self.counters),
+                  'histograms': {}}
+        for name, histogram in self.histograms.items():
+            result['histograms'][name] = histogram.to_dict()
+        return result
+
+    def save(self, path):
+        ''' Write the statistics to path as JSON, and log a summary '''
+        result = self.to_dict()
+        draw = result['histograms']['draw']
+        _logger.info('draw stats: %d frames, p50 %s us, p99 %s us, max %s us'
+                     % (draw['count'], draw['p50'], draw['p99'],
+                        draw['max']))
+        try:
+            fh = open(path, 'w')
+            json.dump(result, fh, indent=2, sort_keys=True)
+            fh.close()
+        except IOError, e:
+            _logger.error('cannot write draw stats to %s: %s' % (path, e))
@@ -0,0 +1,214 @@
+#Copyright (c) 2026 Yellow Dot contributors
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+
+motion.py provides the (x, y, z) readings that shake the dots around.
+
+There are several interchangeable sources:
+
+  DeviceMotion     the accelerometer (see accelerometer.py)
+  SyntheticMotion  seeded random noise, for machines without one
+  MotionRecorder   passes another source through, saving a trace
+  MotionReplay     plays a saved trace back, reading by reading
+
+Readings are in game units (the raw accelerometer value / 18).
+
+A trace is a small binary file: a header (TRACE_HEADER: magic, version,
+flags) followed by one TRACE_RECORD (milliseconds since the start of the
+recording, x, y, z) per reading.
+
+create_motion_source turns a string such as 'synthetic:42' or
+'replay:/tmp/shake.trace' into a source.
+
+'''
+
+import random
+import struct
+import time
+
+from accelerometer import Accelerometer
+
+TRACE_MAGIC = 'YDMT'
+TRACE_VERSION = 1
+TRACE_HEADER = '<4sHH'
+TRACE_RECORD = '<Ihhh'
+TRACE_FROM_DEVICE = 1  # header flag: recorded from a real accelerometer
+# Raw accelerometer units per game unit
+DEVICE_SCALE = 18
+
+
+class MotionSource:
+    ''' Something that produces (x, y, z) readings '''
+
+    # Readings from a real device are gentler than random noise.
+    is_device = False
+
+    def start(self):
+        ''' Get ready to be read (e.g., open the device) '''
+        pass
+
+    def stop(self):
+        ''' Release anything acquired by start '''
+        pass
+
+    def read(self):
+        ''' Return the next (x, y, z) reading. Every source must
+        override this (abstract). '''
+        raise NotImplementedError('%s.read' % (self.__class__.__name__))
+
+
+class DeviceMotion(MotionSource):
+    ''' Readings from the accelerometer, or from fallback (if given) once
+    the accelerometer turns out not to open '''
+
+    is_device = True
+
+    def __init__(self, accelerometer=None, fallback=None):
+        if accelerometer is None:
+            accelerometer = Accelerometer()
+        self._accelerometer = accelerometer
+        self._fallback = fallback
+
+    def available(self):
+        return self._accelerometer.available
+
+    def start(self):
+        if self.is_device:
+            self._accelerometer.start()
+            if self._fallback is not None and not self.available():
+                self.is_device = False
+        if not self.is_device:
+            self._fallback.start()
+
+    def stop(self):
+        if self.is_device:
+            self._accelerometer.stop()
+        else:
+            self._fallback.stop()
+
+    def read(self):
+        if not self.is_device:
+            return self._fallback.read()
+        sample = self._accelerometer.latest()
+        if sample is None:  # nothing sampled yet
+            return (0, 0, 0)
+        return (int(sample[0] / DEVICE_SCALE),
+                int(sample[1] / DEVICE_SCALE),
+                int(sample[2] / DEVICE_SCALE))
+
+
+class SyntheticMotion(MotionSource):
+    ''' Random readings; the same seed gives the same sequence '''
+
+    def __init__(self, seed=None, amplitude=20):
+        self._random = random.Random(seed)
+        self._amplitude = amplitude
+
+    def read(self):
+        a = self._amplitude
+        return (int(self._random.uniform(-a, a)),
+                int(self._random.uniform(-a, a)),
+                int(self._random.uniform(-a, a)))
+
+
+class MotionRecorder(MotionSource):
+    ''' Save the readings of another source to a trace file '''
+
+    def __init__(self, source, path):
+        self._source = source
+        self._path = path
+        self._fh = None
+        self._start = None
+        self.is_device = source.is_device
+
+    def start(self):
+        self._source.start()
+        if self._fh is not None:
+            return
+        if self._start is None:  # first start: write the header
+            self._fh = open(self._path, 'wb')
+            flags = 0
+            if self.is_device:
+                flags |= TRACE_FROM_DEVICE
+            self._fh.write(struct.pack(TRACE_HEADER, TRACE_MAGIC,
+                                       TRACE_VERSION, flags))
+            self._start = time.time()
+        else:  # carry on with the same trace
+            self._fh = open(self._path, 'ab')
+
+    def stop(self):
+        self._source.stop()
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def read(self):
+        x, y, z = self._source.read()
+        if self._fh is not None:
+            ms = int((time.time() - self._start) * 1000)
+            self._fh.write(struct.pack(TRACE_RECORD, ms, x, y, z))
+        return (x, y, z)
+
+
+class MotionReplay(MotionSource):
+    ''' Play back a trace file one reading per read, looping at the end '''
+
+    def __init__(self, path):
+        fh = open(path, 'rb')
+        data = fh.read()
+        fh.close()
+        header_size = struct.calcsize(TRACE_HEADER)
+        magic, version, flags = struct.unpack(TRACE_HEADER,
+                                              data[:header_size])
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError('%s is not a motion trace' % (path))
+        self.is_device = bool(flags & TRACE_FROM_DEVICE)
+        record_size = struct.calcsize(TRACE_RECORD)
+        self.samples = []  # (ms, x, y, z)
+        for i in range(header_size, len(data) - record_size + 1,
+                       record_size):
+            self.samples.append(struct.unpack(TRACE_RECORD,
+                                              data[i:i + record_size]))
+        if len(self.samples) == 0:
+            raise ValueError('%s holds no readings' % (path))
+        self._next = 0
+
+    def read(self):
+        ms, x, y, z = self.samples[self._next]
+        self._next = (self._next + 1) % len(self.samples)
+        return (x, y, z)
+
+
+def create_motion_source(spec=None, seed=None):
+    ''' Make a source from a description:
+            None or 'auto'    the accelerometer if there is one (and it
+                              opens), else synthetic motion
+            'device'          the accelerometer
+            'synthetic[:n]'   synthetic motion seeded with n (or seed)
+            'replay:path'     play back a trace
+            'record:path'     record the 'auto' source to a trace '''
+    if spec is None or spec == 'auto':
+        device = DeviceMotion(fallback=SyntheticMotion(seed))
+        if device.available():
+            return device
+        return SyntheticMotion(seed)
+    kind, sep, arg = spec.partition(':')
+    if kind == 'device':
+        return DeviceMotion()
+    elif kind == 'synthetic':
+        if arg:
+            seed = int(arg)
+        return SyntheticMotion(seed)
+    elif kind == 'replay':
+        return MotionReplay(arg)
+    elif kind == 'record':
+        return MotionRecorder(create_motion_source(None, seed), arg)
+    raise ValueError('unknown motion source %s' % (spec))
@@ -27,16 +27,19 @@ sprites.py is a simple sprites library for managing graphics objects,
 'sprites', on a Gtk.DrawingArea. It manages multiple sprites with
 methods such as move, hide, set_layer, etc.
 
-There are two classes:
+There are three classes:
 
 class Sprites maintains a collection of sprites
 class Sprite manages individual sprites within the collection.
+class AtlasRegion lets many sprites share one image surface (an atlas),
+each drawing its own rectangle of it.
 
 Example usage:
         # Import the classes into your program.
         from sprites import Sprites Sprite
 
         # Create a new sprite collection associated with your widget
+        # (or with None, to draw offscreen and collect the damage yourself)
         self.sprite_list = Sprites(widget)
 
         # Create a "pixbuf" (in this example, from SVG).
@@ -77,24 +80,99 @@ def svg_str_to_pixbuf(svg_string):
 '''
 
 import gi
-from gi.repository import Gtk, GdkPixbuf, Gdk
+from gi.repository import Gtk, GdkPixbuf, Gdk, GObject
 from gi.repository import Pango, PangoCairo
 import cairo
+import sys
+from bisect import bisect_left, bisect_right
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Size of the buckets in the hit-test grid
+HIT_CELL_SIZE = 64
+# Laid-out labels remembered per sprite
+LABEL_CACHE_SIZE = 8
+# Beyond this many dirty rectangles, redraw their bounding box instead
+MAX_DIRTY_RECTS = 32
+# Pixels at least this opaque count as part of a sprite's shape
+MASK_ALPHA = 128
+# Where the red, green, blue and alpha bytes of a cairo pixel are
+if sys.byteorder == 'little':
+    CAIRO_RGBA = (2, 1, 0, 3)
+else:
+    CAIRO_RGBA = (1, 2, 3, 0)
 
 
 class Sprites:
     ''' A class for the list of sprites and everything they share in common '''
 
-    def __init__(self, widget):
-        ''' Initialize an empty array of sprites '''
+    def __init__(self, widget=None):
+        ''' Initialize an empty array of sprites; with no widget, the
+        invalidated regions are recorded (see take_damage) instead. '''
         self.cr = None
         self.widget = widget
-        self.list = []
+        self.damage = []  # flushed rectangles, when there is no widget
+        self.stats = None  # an instrument.DrawStats, when instrumented
+        self._static_layer = None  # sprites at or below it are cached...
+        self._static_size = None
+        self._static = None  # ...in this surface...
+        self._static_dirty = []  # ...except for these rectangles
+        self.list = []  # sorted by (layer, insertion sequence)
+        self._keys = []  # the (layer, sequence) key of each sprite in list
+        self._cells = {}  # (column, row) --> {sprite: True} for that cell
+        self._seq = 0  # bumped each time a sprite is (re)inserted
+        self._pango_context = None
+        self._masks = {}  # image --> _AlphaMask, for exact hit tests
+        self._dirty = []  # (x, y, w, h) rectangles to redraw next frame
+        self._flush_id = None
+        self.reset_inval_stats()
 
     def set_cairo_context(self, cr):
         ''' Cairo context may be set or reset after __init__ '''
         self.cr = cr
 
+    def get_scale_factor(self):
+        ''' Device pixels per logical pixel of the widget's window '''
+        window = None
+        if self.widget is not None and hasattr(self.widget, 'get_window'):
+            window = self.widget.get_window()
+        if window is not None and hasattr(window, 'get_scale_factor'):
+            return window.get_scale_factor()
+        return 1
+
+    def create_surface(self, width, height, opaque=False):
+        ''' An image surface of width x height (logical) pixels in the
+        format and at the scale of the widget's window, so drawing it
+        there needs no conversion. Opaque surfaces are RGB24. Without a
+        realized window, a plain cairo.ImageSurface is made. '''
+        width = max(1, int(width))
+        height = max(1, int(height))
+        if opaque:
+            format = cairo.FORMAT_RGB24
+        else:
+            format = cairo.FORMAT_ARGB32
+        window = None
+        if self.widget is not None and hasattr(self.widget, 'get_window'):
+            window = self.widget.get_window()
+        if window is not None and \
+                hasattr(window, 'create_similar_image_surface'):
+            scale = self.get_scale_factor()
+            try:
+                return window.create_similar_image_surface(
+                    format, width * scale, height * scale, scale)
+            except (TypeError, cairo.Error):
+                pass
+        return cairo.ImageSurface(format, width, height)
+
+    def get_pango_context(self):
+        ''' A Pango context for measuring labels outside of a draw '''
+        if self._pango_context is None:
+            self._pango_context = \
+                PangoCairo.FontMap.get_default().create_context()
+        return self._pango_context
+
     def get_sprite(self, i):
         ''' Return a sprint from the array '''
         if i < 0 or i > len(self.list)-1:
@@ -107,34 +185,269 @@ class Sprites:
         return(len(self.list))
 
     def append_to_list(self, spr):
-        ''' Append a new sprite to the end of the list. '''
-        self.list.append(spr)
+        ''' Add a sprite on top of the other sprites in its layer. '''
+        self._seq += 1
+        spr._key = (spr.layer, self._seq)
+        i = bisect_right(self._keys, spr._key)
+        self.list.insert(i, spr)
+        self._keys.insert(i, spr._key)
+        self._add_to_index(spr)
+        self._static_changed(spr)
 
     def insert_in_list(self, spr, i):
-        ''' Insert a sprite at position i. '''
-        if i < 0:
-            self.list.insert(0, spr)
-        elif i > len(self.list) - 1:
-            self.list.append(spr)
-        else:
-            self.list.insert(i, spr)
+        ''' Insert a sprite. The list is kept sorted by layer, so the
+        position i is only a hint and is otherwise ignored. '''
+        self.append_to_list(spr)
 
     def remove_from_list(self, spr):
         ''' Remove a sprite from the list. '''
-        if spr in self.list:
-            self.list.remove(spr)
+        if spr._cells is None:  # not in the list
+            return
+        self._static_changed(spr)
+        i = bisect_left(self._keys, spr._key)
+        del self.list[i]
+        del self._keys[i]
+        self._remove_from_index(spr)
+
+    def set_layers(self, sprites, layer):
+        ''' Move a batch of sprites (in order) to a layer, sorting once '''
+        sprites = list(sprites)
+        for spr in sprites:
+            if spr._cells is None:  # restore hidden sprites, as set_layer does
+                self.list.append(spr)
+                self._add_to_index(spr)
+            else:
+                self._static_changed(spr)
+            spr.layer = layer
+            self._seq += 1
+            spr._key = (layer, self._seq)
+        self.list.sort(key=lambda spr: spr._key)
+        self._keys = [spr._key for spr in self.list]
+        for spr in sprites:
+            spr.inval()
+
+    def _add_to_index(self, spr):
+        ''' Add a sprite to the hit-test grid '''
+        x0 = spr.rect[0] // HIT_CELL_SIZE
+        y0 = spr.rect[1] // HIT_CELL_SIZE
+        x1 = (spr.rect[0] + spr.rect[2]) // HIT_CELL_SIZE
+        y1 = (spr.rect[1] + spr.rect[3]) // HIT_CELL_SIZE
+        if spr._cells == (x0, y0, x1, y1):  # still in the same cells
+            return
+        self._remove_from_index(spr)
+        spr._cells = (x0, y0, x1, y1)
+        for col in range(x0, x1 + 1):
+            for row in range(y0, y1 + 1):
+                self._cells.setdefault((col, row), {})[spr] = True
+
+    def _remove_from_index(self, spr):
+        ''' Remove a sprite from the hit-test grid '''
+        if spr._cells is None:
+            return
+        x0, y0, x1, y1 = spr._cells
+        for col in range(x0, x1 + 1):
+            for row in range(y0, y1 + 1):
+                bucket = self._cells[(col, row)]
+                del bucket[spr]
+                if len(bucket) == 0:
+                    del self._cells[(col, row)]
+        spr._cells = None
+
+    def update_index(self, spr):
+        ''' Refresh the hit-test grid after a sprite moved or resized '''
+        if spr._cells is None:  # not in the list (e.g., hidden)
+            return
+        self._add_to_index(spr)
+
+    def _sprites_in(self, rects):
+        ''' The sprites that may overlap any of rects, in drawing order.
+        Small regions are looked up in the hit-test grid; large ones are
+        cheaper to check against every sprite. '''
+        cells = []
+        for x, y, w, h in rects:
+            x0 = int(x) // HIT_CELL_SIZE
+            y0 = int(y) // HIT_CELL_SIZE
+            x1 = int(x + w) // HIT_CELL_SIZE
+            y1 = int(y + h) // HIT_CELL_SIZE
+            if len(cells) + (x1 - x0 + 1) * (y1 - y0 + 1) > len(self._cells):
+                return self.list
+            for col in range(x0, x1 + 1):
+                for row in range(y0, y1 + 1):
+                    cells.append((col, row))
+        found = {}
+        for cell in cells:
+            for spr in self._cells.get(cell, ()):
+                found[spr] = spr._key
+        return sorted(found, key=found.get)
 
     def find_sprite(self, pos):
         ''' Search based on (x, y) position. Return the 'top/first' one. '''
-        list = self.list[:]
-        list.reverse()
-        for spr in list:
+        bucket = self._cells.get((int(pos[0]) // HIT_CELL_SIZE,
+                                  int(pos[1]) // HIT_CELL_SIZE))
+        if bucket is None:
+            return None
+        top = None
+        for spr in bucket:
             if spr.hit(pos):
-                return spr
-        return None
+                if top is None or spr._key > top._key:
+                    top = spr
+        return top
+
+    def get_mask(self, image):
+        ''' The alpha mask of an image, shared by the sprites using it.
+        It is best made (by calling this) as soon as the image is drawn,
+        rather than on the first hit test. '''
+        mask = self._masks.get(image)
+        if mask is None:
+            mask = self._masks[image] = _AlphaMask(_Pixels(image))
+        return mask
+
+    def forget_mask(self, image):
+        ''' Drop the alpha mask of an image that is no longer used '''
+        self._masks.pop(image, None)
+
+    def set_static_layer(self, layer, size=None):
+        ''' Flatten the sprites at or below layer into one cached surface
+        of size (w, h), by default just big enough to hold them. Only the
+        parts of it where those sprites change are drawn again; each
+        frame is then one blit plus the sprites above layer. None turns
+        the cache off. '''
+        self._static_layer = layer
+        self._static = None
+        self._static_dirty = []
+        if layer is not None and size is None:
+            w, h = 0, 0
+            for spr in self.list:
+                if spr.layer <= layer:
+                    w = max(w, spr.rect[0] + spr.rect[2])
+                    h = max(h, spr.rect[1] + spr.rect[3])
+            size = (w, h)
+        self._static_size = size
+
+    def _static_changed(self, spr, rect=None):
+        ''' Note that a sprite in the static layer has changed (within
+        rect; by default, everywhere it is drawn) '''
+        if self._static is None or spr.layer > self._static_layer:
+            return
+        if rect is not None:
+            rects = [tuple(rect)]
+        else:
+            rects = [tuple(spr.rect)] + [_pad_label_rect(r) for r in
+                                         spr._label_rects if r is not None]
+        self._static_dirty.extend(rects)
+        if len(self._static_dirty) > MAX_DIRTY_RECTS:
+            self._static_dirty = [_bounding_box(self._static_dirty)]
+
+    def _update_static(self):
+        ''' Bring the cached static layer up to date '''
+        if self._static is None:
+            w, h = self._static_size
+            self._static = self.create_surface(w, h)
+            dirty = [(0, 0, int(w), int(h))]
+        else:
+            dirty = self._static_dirty
+        self._static_dirty = []
+        if len(dirty) == 0:
+            return
+        cr = cairo.Context(self._static)
+        for rect in dirty:
+            cr.rectangle(*rect)
+        cr.clip()
+        cr.set_operator(cairo.OPERATOR_CLEAR)
+        cr.paint()
+        cr.set_operator(cairo.OPERATOR_OVER)
+        for spr in self._sprites_in(dirty):
+            if spr.layer > self._static_layer:
+                continue
+            for rect in dirty:
+                if spr.intersects(rect):
+                    spr.draw(cr=cr)
+                    break
+
+    def invalidate(self, rect, spr=None):
+        ''' Add an (x, y, w, h) rectangle to the region to be redrawn.
+        Overlapping and adjacent rectangles are merged, and the result is
+        handed to gtk once per frame, just before it redraws. spr is the
+        sprite that changed there, if any. '''
+        x, y, w, h = rect
+        if w <= 0 or h <= 0:
+            return
+        if spr is not None:
+            self._static_changed(spr, rect)
+        i = 0
+        while i < len(self._dirty):
+            dx, dy, dw, dh = self._dirty[i]
+            if dx <= x + w and x <= dx + dw and dy <= y + h and y <= dy + dh:
+                x1 = max(x + w, dx + dw)
+                y1 = max(y + h, dy + dh)
+                x = min(x, dx)
+                y = min(y, dy)
+                w = x1 - x
+                h = y1 - y
+                del self._dirty[i]
+                i = 0  # the union may now touch rectangles already checked
+            else:
+                i += 1
+        self._dirty.append((x, y, w, h))
+        if len(self._dirty) > MAX_DIRTY_RECTS:
+            # Many small changes (e.g., every dot moving): one big one
+            self._dirty = [_bounding_box(self._dirty)]
+        if self._flush_id is None and self.widget is not None:
+            # Changes made by event handlers and timeouts are flushed ahead
+            # of the frame clock, which is dispatched at PRIORITY_HIGH_IDLE
+            # + 20. Changes made by tick callbacks, inside the frame clock,
+            # would only be flushed after it has painted: those callers
+            # (Animator, RubRecognizer) call flush() themselves.
+            self._flush_id = GObject.idle_add(
+                self._flush_idle, priority=GObject.PRIORITY_HIGH_IDLE)
+
+    def _flush_idle(self):
+        self._flush_id = None
+        self.flush()
+        return False
+
+    def flush(self):
+        ''' Queue the coalesced dirty rectangles for redrawing '''
+        if self._flush_id is not None:
+            GObject.source_remove(self._flush_id)
+            self._flush_id = None
+        if len(self._dirty) == 0:
+            return False
+        dirty = self._dirty
+        self._dirty = []
+        self.inval_frames += 1
+        for x, y, w, h in dirty:
+            self.inval_rects += 1
+            self.inval_pixels += w * h
+            if self.widget is None:
+                self.damage.append((x, y, w, h))
+            else:
+                self.widget.queue_draw_area(x, y, w, h)
+        return False
+
+    def take_damage(self):
+        ''' Return (and forget) the rectangles invalidated since the last
+        call, for drawing without a widget '''
+        self.flush()
+        damage = self.damage
+        self.damage = []
+        return damage
+
+    def reset_inval_stats(self):
+        ''' Zero the invalidation counters '''
+        self.inval_frames = 0  # flushes that queued at least one rectangle
+        self.inval_rects = 0  # rectangles queued after merging
+        self.inval_pixels = 0  # area of those rectangles
+
+    def get_inval_stats(self):
+        ''' Return the invalidation counters '''
+        return {'frames': self.inval_frames,
+                'rects': self.inval_rects,
+                'pixels': self.inval_pixels}
 
     def redraw_sprites(self, area=None, cr=None):
-        ''' Redraw the sprites that intersect area. '''
+        ''' Redraw the sprites that intersect area (by default, the
+        region cairo has been clipped to). '''
         # I think I need to do this to save Cairo some work
         if cr is None:
             cr = self.cr
@@ -143,13 +456,192 @@ class Sprites:
         if cr is None:
             print 'sprites.redraw_sprites: no Cairo context'
             return
-        for spr in self.list:
-            if area == None:
-                spr.draw(cr=cr)
-            else:
-                intersection = spr.rect.intersect(area)
-                if intersection.width > 0 or intersection.height > 0:
+        if area is None:
+            rects = clip_rectangles(cr)
+        elif hasattr(area, 'width'):  # Gdk.Rectangle or cairo.RectangleInt
+            rects = [(area.x, area.y, area.width, area.height)]
+        else:
+            rects = [area]
+        stats = self.stats
+        drawn = 0
+        sprites = self._sprites_in(rects)
+        if self._static_layer is not None:
+            self._update_static()
+            cr.save()
+            for rect in rects:
+                cr.rectangle(*rect)
+            cr.clip()
+            cr.set_source_surface(self._static, 0, 0)
+            cr.paint()
+            cr.restore()
+            sprites = [spr for spr in sprites
+                       if spr.layer > self._static_layer]
+        for spr in sprites:
+            for rect in rects:
+                if spr.intersects(rect):
                     spr.draw(cr=cr)
+                    drawn += 1
+                    if stats is not None:
+                        stats.sprite_drawn(spr, rect)
+                    break
+        if stats is not None:
+            stats.frame_done(len(self.list), drawn)
+
+
+def _set_layout(pl, fd, text, size):
+    ''' Lay out text at a font size (in Pango units); return its width '''
+    fd.set_size(size)
+    pl.set_font_description(fd)
+    pl.set_text(text, -1)
+    return pl.get_size()[0] / Pango.SCALE
+
+
+def _bounding_box(rects):
+    ''' The smallest (x, y, w, h) rectangle holding all of rects '''
+    x0 = min([r[0] for r in rects])
+    y0 = min([r[1] for r in rects])
+    x1 = max([r[0] + r[2] for r in rects])
+    y1 = max([r[1] + r[3] for r in rects])
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def _pad_label_rect(rect):
+    ''' Leave room for glyphs that overhang their logical extents '''
+    pad = rect[3] / 4 + 1
+    return (rect[0] - pad, rect[1] - pad, rect[2] + 2 * pad,
+            rect[3] + 2 * pad)
+
+
+def clip_rectangles(cr):
+    ''' Return the clip region of a cairo context as (x, y, w, h) '''
+    try:
+        return [(r.x, r.y, r.width, r.height)
+                for r in cr.copy_clip_rectangle_list()]
+    except (AttributeError, cairo.Error):
+        # Older pycairo, or a clip that is not a list of rectangles
+        x1, y1, x2, y2 = cr.clip_extents()
+        return [(x1, y1, x2 - x1, y2 - y1)]
+
+
+class AtlasRegion:
+    ''' A rectangle of a shared image surface, used as a sprite image '''
+
+    def __init__(self, surface, x, y, width, height):
+        self.surface = surface
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    def get_width(self):
+        return self.width
+
+    def get_height(self):
+        return self.height
+
+
+class _Pixels:
+    ''' Reads the pixels of a sprite image in place: a memoryview over the
+    data of an image surface, or over a pixbuf's pixels (which PyGObject
+    can only hand over as a copy, so it is made once). Coordinates are
+    in logical pixels, from the top left of the image. '''
+
+    def __init__(self, image):
+        self.width = int(image.get_width())
+        self.height = int(image.get_height())
+        self.surface = image
+        self._x0, self._y0 = 0, 0
+        if isinstance(image, AtlasRegion):
+            self.surface = image.surface
+            self._x0, self._y0 = image.x, image.y
+        self._sx, self._sy = 1, 1
+        if isinstance(self.surface, cairo.ImageSurface):
+            if hasattr(self.surface, 'get_device_scale'):
+                self._sx, self._sy = self.surface.get_device_scale()
+            if not isinstance(image, AtlasRegion):
+                self.width = int(self.width / self._sx)
+                self.height = int(self.height / self._sy)
+            self.surface.flush()
+            self._buffer = self.surface.get_data()
+            self._stride = self.surface.get_stride()
+            self._channels = 4
+            self._rgba = CAIRO_RGBA
+            self._alpha = self.surface.get_format() == cairo.FORMAT_ARGB32
+            self._premultiplied = True
+        else:
+            self._buffer = self.surface.get_pixels()
+            self._stride = self.surface.get_rowstride()
+            self._channels = self.surface.get_n_channels()
+            self._rgba = (0, 1, 2, 3)
+            self._alpha = self.surface.get_has_alpha()
+            self._premultiplied = False
+        self._data = memoryview(self._buffer)
+
+    def alphas(self):
+        ''' The alpha of every pixel, as a (height, width) numpy array '''
+        if not self._alpha:
+            return numpy.ones((self.height, self.width), numpy.uint8) * 255
+        ys = ((self._y0 + numpy.arange(self.height)) * self._sy).astype(int)
+        xs = ((self._x0 + numpy.arange(self.width)) * self._sx).astype(int)
+        data = numpy.frombuffer(self._buffer, numpy.uint8)
+        return data[ys[:, None] * self._stride + xs * self._channels +
+                    self._rgba[3]]
+
+    def _offset(self, x, y):
+        ''' Where the pixel at (x, y) starts in the data, or -1 '''
+        if x < 0 or y < 0 or x >= self.width or y >= self.height:
+            return -1
+        return int((self._y0 + y) * self._sy) * self._stride + \
+            int((self._x0 + x) * self._sx) * self._channels
+
+    def alpha(self, x, y):
+        ''' The alpha (0-255) at (x, y); 0 outside of the image '''
+        offset = self._offset(x, y)
+        if offset < 0:
+            return 0
+        if not self._alpha:
+            return 255
+        return ord(self._data[offset + self._rgba[3]])
+
+    def get(self, x, y):
+        ''' The (r, g, b, a) at (x, y), or (-1, -1, -1, -1) outside '''
+        offset = self._offset(x, y)
+        if offset < 0:
+            return (-1, -1, -1, -1)
+        data = self._data
+        r = ord(data[offset + self._rgba[0]])
+        g = ord(data[offset + self._rgba[1]])
+        b = ord(data[offset + self._rgba[2]])
+        a = 255
+        if self._alpha:
+            a = ord(data[offset + self._rgba[3]])
+            if self._premultiplied and 0 < a < 255:
+                r, g, b = r * 255 / a, g * 255 / a, b * 255 / a
+        return (r, g, b, a)
+
+
+class _AlphaMask:
+    ''' One bit per pixel, the leftmost in the high bit of each byte: is
+    the image opaque there? '''
+
+    def __init__(self, pixels, threshold=MASK_ALPHA):
+        self.width = pixels.width
+        self.height = pixels.height
+        self._row = (self.width + 7) >> 3  # bytes per row
+        if numpy is not None:
+            self._bits = bytearray(numpy.packbits(
+                    pixels.alphas() >= threshold, axis=1).tostring())
+            return
+        self._bits = bytearray(self._row * self.height)
+        for y in range(self.height):
+            for x in range(self.width):
+                if pixels.alpha(x, y) >= threshold:
+                    self._bits[y * self._row + (x >> 3)] |= 0x80 >> (x & 7)
+
+    def opaque(self, x, y):
+        if x < 0 or y < 0 or x >= self.width or y >= self.height:
+            return False
+        return self._bits[y * self._row + (x >> 3)] & (0x80 >> (x & 7)) != 0
 
 
 class Sprite:
@@ -167,16 +659,24 @@ class Sprite:
         self._x_pos = [None]
         self._y_pos = [None]
         self._fd = None
+        self._font = None
+        self._layouts = {}  # (text, scale, ...) --> (layout, width, height)
         self._bold = False
         self._italic = False
         self._color = None
         self._margins = [0, 0, 0, 0]
         self.layer = 100
         self.labels = []
+        self._label_rects = []  # where each label was last drawn
         self.images = []
         self._dx = []  # image offsets
         self._dy = []
+        self._pixels = []  # _Pixels for each image, made when first read
+        self._mask = None  # alpha mask of the first image, if exact_hit
+        self.exact_hit = False
         self.type = None
+        self._cells = None  # extent in the hit-test grid
+        self._key = None  # (layer, sequence) position in the list
         self.set_image(image)
         self._sprites.append_to_list(self)
 
@@ -186,7 +686,11 @@ class Sprite:
             self.images.append(None)
             self._dx.append(0)
             self._dy.append(0)
+            self._pixels.append(None)
         self.images[i] = image
+        self._pixels[i] = None
+        if i == 0:
+            self._mask = None
         self._dx[i] = dx
         self._dy[i] = dy
         if hasattr(self.images[i], 'get_width'):
@@ -194,6 +698,11 @@ class Sprite:
             h = self.images[i].get_height()
         else:
             w, h = self.images[i].get_size()
+        if hasattr(self.images[i], 'get_device_scale'):
+            # A HiDPI surface is drawn at its size in logical pixels.
+            sx, sy = self.images[i].get_device_scale()
+            w = int(w / sx)
+            h = int(h / sy)
         if i == 0:  # Always reset width and height when base image changes.
             self.rect[2] = w + dx
             self.rect[3] = h + dy
@@ -202,11 +711,13 @@ class Sprite:
                 self.rect[2] = w + dx
             if h + dy > self.rect[3]:
                 self.rect[3] = h + dy
+        self._sprites.update_index(self)
 
     def move(self, pos):
         ''' Move to new (x, y) position '''
         self.inval()
         self.rect[0], self.rect[1] = int(pos[0]), int(pos[1])
+        self._sprites.update_index(self)
         self.inval()
 
     def move_relative(self, pos):
@@ -214,6 +725,7 @@ class Sprite:
         self.inval()
         self.rect[0] += int(pos[0])
         self.rect[1] += int(pos[1])
+        self._sprites.update_index(self)
         self.inval()
 
     def get_xy(self):
@@ -239,11 +751,6 @@ class Sprite:
         self._sprites.remove_from_list(self)
         if layer is not None:
             self.layer = layer
-        for i in range(self._sprites.length_of_list()):
-            if self.layer < self._sprites.get_sprite(i).layer:
-                self._sprites.insert_in_list(self, i)
-                self.inval()
-                return
         self._sprites.append_to_list(self)
         self.inval()
 
@@ -252,10 +759,14 @@ class Sprite:
         self._extend_labels_array(i)
         if type(new_label) is str or type(new_label) is unicode:
             # pango doesn't like nulls
-            self.labels[i] = new_label.replace("\0", " ")
+            new_label = new_label.replace("\0", " ")
         else:
-            self.labels[i] = str(new_label)
-        self.inval()
+            new_label = str(new_label)
+        if new_label == self.labels[i]:
+            return
+        self._inval_label(i)  # where the old label was drawn
+        self.labels[i] = new_label
+        self._inval_label(i, self._label_extents(i))
 
     def set_margins(self, l=0, t=0, r=0, b=0):
         ''' Set the margins for drawing the label '''
@@ -269,6 +780,7 @@ class Sprite:
             self._color = (0., 0., 0.)
         while len(self.labels) < i + 1:
             self.labels.append(" ")
+            self._label_rects.append(None)
             self._scale.append(self._scale[0])
             self._rescale.append(self._rescale[0])
             self._horiz_align.append(self._horiz_align[0])
@@ -279,6 +791,7 @@ class Sprite:
     def set_font(self, font):
         ''' Set the font for a label '''
         self._fd = Pango.FontDescription(font)
+        self._font = font
 
     def set_label_color(self, rgb):
         ''' Set the font color for a label '''
@@ -318,10 +831,15 @@ class Sprite:
     def inval(self):
         ''' Invalidate a region for gtk '''
         # self._sprites.window.invalidate_rect(self.rect, False)
-        self._sprites.widget.queue_draw_area(self.rect[0],
-                                             self.rect[1],
-                                             self.rect[2],
-                                             self.rect[3])
+        self._sprites.invalidate(self.rect, self)
+
+    def _inval_label(self, i, rect=None):
+        ''' Invalidate the area covered by a label '''
+        if rect is None:
+            rect = self._label_rects[i]
+            if rect is None:
+                return
+        self._sprites.invalidate(_pad_label_rect(rect), self)
 
     def draw(self, cr=None):
         ''' Draw the sprite (and label) '''
@@ -340,7 +858,7 @@ class Sprite:
                              self.rect[2],
                              self.rect[3])
                 cr.fill()
-            elif type(img) == cairo.ImageSurface:
+            elif isinstance(img, cairo.Surface):
                 cr.set_source_surface(img, self.rect[0] + self._dx[i],
                                       self.rect[1] + self._dy[i])
                 cr.rectangle(self.rect[0] + self._dx[i],
@@ -348,13 +866,33 @@ class Sprite:
                              self.rect[2],
                              self.rect[3])
                 cr.fill()
+            elif isinstance(img, AtlasRegion):
+                x = self.rect[0] + self._dx[i]
+                y = self.rect[1] + self._dy[i]
+                cr.set_source_surface(img.surface, x - img.x, y - img.y)
+                cr.rectangle(x, y, img.width, img.height)
+                cr.fill()
             else:
                 print 'sprite.draw: source not a pixbuf (%s)' % (type(img))
         if len(self.labels) > 0:
-            self.draw_label(cr)
+            stats = self._sprites.stats
+            if stats is None:
+                self.draw_label(cr)
+            else:
+                start = stats.clock()
+                self.draw_label(cr)
+                stats.record('label', start)
+
+    def intersects(self, rect):
+        ''' Does the sprite overlap an (x, y, w, h) rectangle? '''
+        return self.rect[0] < rect[0] + rect[2] and \
+            rect[0] < self.rect[0] + self.rect[2] and \
+            self.rect[1] < rect[1] + rect[3] and \
+            rect[1] < self.rect[1] + self.rect[3]
 
     def hit(self, pos):
-        ''' Is (x, y) on top of the sprite? '''
+        ''' Is (x, y) on top of the sprite? With exact_hit, only the
+        opaque pixels of its (first) image count. '''
         x, y = pos
         if x < self.rect[0]:
             return False
@@ -364,70 +902,110 @@ class Sprite:
             return False
         if y > self.rect[1] + self.rect[3]:
             return False
+        if self.exact_hit:
+            if self._mask is None:
+                self._mask = self._sprites.get_mask(self.images[0])
+            return self._mask.opaque(int(x - self.rect[0] - self._dx[0]),
+                                     int(y - self.rect[1] - self._dy[0]))
         return True
 
     def draw_label(self, cr):
         ''' Draw the label based on its attributes '''
-        my_width = self.rect[2] - self._margins[0] - self._margins[2]
-        if my_width < 0:
-            my_width = 0
-        my_height = self.rect[3] - self._margins[1] - self._margins[3]
         for i in range(len(self.labels)):
-            pl = PangoCairo.create_layout(cr)
-            pl.set_text(str(self.labels[i]), -1)
-            self._fd.set_size(int(self._scale[i] * Pango.SCALE))
-            pl.set_font_description(self._fd)
-            w = pl.get_size()[0] / Pango.SCALE
-            if w > my_width:
-                if self._rescale[i]:
-                    self._fd.set_size(
-                            int(self._scale[i] * Pango.SCALE * my_width / w))
-                    pl.set_font_description(self._fd)
-                    w = pl.get_size()[0] / Pango.SCALE
-                else:
-                    j = len(self.labels[i]) - 1
-                    while(w > my_width and j > 0):
-                        pl.set_text(
-                            "…" + self.labels[i][len(self.labels[i]) - j:], -1)
-                        self._fd.set_size(int(self._scale[i] * Pango.SCALE))
-                        pl.set_font_description(self._fd)
-                        w = pl.get_size()[0] / Pango.SCALE
-                        j -= 1
-            if self._x_pos[i] is not None:
-                x = int(self.rect[0] + self._x_pos[i])
-            elif self._horiz_align[i] == "center":
-                x = int(self.rect[0] + self._margins[0] + (my_width - w) / 2)
-            elif self._horiz_align[i] == 'left':
-                x = int(self.rect[0] + self._margins[0])
-            else: # right
-                x = int(self.rect[0] + self.rect[2] - w - self._margins[2])
-            h = pl.get_size()[1] / Pango.SCALE
-            if self._y_pos[i] is not None:
-                y = int(self.rect[1] + self._y_pos[i])
-            elif self._vert_align[i] == "middle":
-                y = int(self.rect[1] + self._margins[1] + (my_height - h) / 2)
-            elif self._vert_align[i] == "top":
-                y = int(self.rect[1] + self._margins[1])
-            else: # bottom
-                y = int(self.rect[1] + self.rect[3] - h - self._margins[3])
+            pl, x, y, w, h = self._layout_label(i)
+            self._label_rects[i] = (x, y, w, h)
             cr.save()
             cr.translate(x, y)
             cr.set_source_rgb(self._color[0], self._color[1], self._color[2])
-            PangoCairo.update_layout(cr, pl)
+            # The layout comes from our own context, so there is no need to
+            # update_layout (which would force it to be laid out again).
             PangoCairo.show_layout(cr, pl)
             cr.restore()
 
+    def _label_extents(self, i):
+        ''' Where would label i be drawn? '''
+        return self._layout_label(i)[1:]
+
+    def _layout_label(self, i):
+        ''' Position label i based on its attributes; return the layout
+        and its (x, y, w, h) '''
+        my_width = self.rect[2] - self._margins[0] - self._margins[2]
+        if my_width < 0:
+            my_width = 0
+        my_height = self.rect[3] - self._margins[1] - self._margins[3]
+        pl, w, h = self._get_layout(i, my_width)
+        if self._x_pos[i] is not None:
+            x = int(self.rect[0] + self._x_pos[i])
+        elif self._horiz_align[i] == "center":
+            x = int(self.rect[0] + self._margins[0] + (my_width - w) / 2)
+        elif self._horiz_align[i] == 'left':
+            x = int(self.rect[0] + self._margins[0])
+        else: # right
+            x = int(self.rect[0] + self.rect[2] - w - self._margins[2])
+        if self._y_pos[i] is not None:
+            y = int(self.rect[1] + self._y_pos[i])
+        elif self._vert_align[i] == "middle":
+            y = int(self.rect[1] + self._margins[1] + (my_height - h) / 2)
+        elif self._vert_align[i] == "top":
+            y = int(self.rect[1] + self._margins[1])
+        else: # bottom
+            y = int(self.rect[1] + self.rect[3] - h - self._margins[3])
+        return (pl, x, y, w, h)
+
+    def _get_layout(self, i, my_width=None):
+        ''' Return (layout, w, h) for label i, shrunk or truncated to fit
+        in my_width. Layouts are cached until the label changes. '''
+        key = (self.labels[i], self._scale[i], self._rescale[i], my_width,
+               self._font)
+        if key in self._layouts:
+            return self._layouts[key]
+        if len(self._layouts) >= LABEL_CACHE_SIZE:
+            self._layouts.clear()
+        if self._sprites.stats is not None:
+            self._sprites.stats.count('labels_laid_out')
+
+        pl = Pango.Layout.new(self._sprites.get_pango_context())
+        fd = self._fd.copy()  # leave the font size of self._fd alone
+        text = self.labels[i]
+        if type(text) is str:
+            text = text.decode('utf-8', 'replace')
+        size = int(self._scale[i] * Pango.SCALE)
+        w = _set_layout(pl, fd, text, size)
+        if my_width is not None and w > my_width:
+            if self._rescale[i]:
+                # Text width is close to proportional to the font size...
+                size = max(1, int(size * my_width / w))
+                w = _set_layout(pl, fd, text, size)
+                if w > my_width:
+                    # ...but hinting can leave it a little too wide.
+                    lo, hi = 1, size - 1
+                    while lo < hi:
+                        mid = (lo + hi + 1) / 2
+                        if _set_layout(pl, fd, text, mid) <= my_width:
+                            lo = mid
+                        else:
+                            hi = mid - 1
+                    w = _set_layout(pl, fd, text, lo)
+            elif len(text) > 1:
+                # Keep as many trailing characters as will fit.
+                lo, hi = 1, len(text) - 1
+                while lo < hi:
+                    mid = (lo + hi + 1) / 2
+                    if _set_layout(pl, fd, u"…" + text[-mid:], size) <= \
+                            my_width:
+                        lo = mid
+                    else:
+                        hi = mid - 1
+                w = _set_layout(pl, fd, u"…" + text[-lo:], size)
+        h = pl.get_size()[1] / Pango.SCALE
+        self._layouts[key] = (pl, w, h)
+        return self._layouts[key]
+
     def label_width(self, cr=None):
         ''' Calculate the width of a label '''
-        if cr is None:
-            cr = self._sprites.cr
         max = 0
         for i in range(len(self.labels)):
-            pl = PangoCairo.create_layout(cr)
-            pl.set_text(str(self.labels[i]), -1)
-            self._fd.set_size(int(self._scale[i] * Pango.SCALE))
-            pl.set_font_description(self._fd)
-            w = pl.get_size()[0] / Pango.SCALE
+            w = self._get_layout(i)[1]
             if w > max:
                 max = w
         return max
@@ -445,21 +1023,10 @@ class Sprite:
         return(self._margins[0], self._margins[1])
 
     def get_pixel(self, pos, i=0):
-        ''' Return the pixl at (x, y) '''
-        x, y = pos
-        x = x - self.rect[0]
-        y = y - self.rect[1]
-        if y > self.images[i].get_height() - 1:
-            return(-1, -1, -1, -1)
-        try:
-            array = self.images[i].get_pixels()
-            if array is not None:
-                offset = (y * self.images[i].get_width() + x) * 4
-                r, g, b, a = ord(array[offset]), ord(array[offset + 1]),\
-                             ord(array[offset + 2]), ord(array[offset + 3])
-                return(r, g, b, a)
-            else:
-                return(-1, -1, -1, -1)
-        except IndexError:
-            print "Index Error: %d %d" % (len(array), offset)
-            return(-1, -1, -1, -1)
+        ''' Return the pixel at (x, y) as (r, g, b, a) '''
+        pixels = self._pixels[i]
+        if pixels is None or (isinstance(self.images[i], AtlasRegion) and
+                              pixels.surface is not self.images[i].surface):
+            pixels = self._pixels[i] = _Pixels(self.images[i])
+        return pixels.get(int(pos[0] - self.rect[0] - self._dx[i]),
+                          int(pos[1] - self.rect[1] - self._dy[i]))
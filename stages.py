@@ -0,0 +1,129 @@
+#Copyright (c) 2026 Yellow Dot contributors
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+'''
+
+stages.py steps a game through a table of stages.
+
+Each Stage has an action (run when the stage advances, whether because
+of input or a timer), an optional on_enter callback, timers that run
+while the stage is current, and an optional delay after which it
+advances by itself.
+
+The engine owns every GLib timeout it creates. Leaving a stage cancels
+its timers, and at most one transition is ever pending, so repeated
+requests (e.g., from a physics loop or several matching taps) cannot
+pile up. live_timers() reports how many sources are outstanding.
+
+Example usage:
+        engine = StageEngine()
+        engine.add_stage('hello', Stage(say_hello, delay=500))
+        engine.enter('hello')
+
+'''
+
+from gi.repository import GObject
+
+import logging
+_logger = logging.getLogger('click-activity')
+
+
+class Stage:
+    ''' One step of the game '''
+
+    def __init__(self, action, on_enter=None, timers=(), delay=None):
+        self.action = action
+        self.on_enter = on_enter
+        self.timers = timers  # (ms, callback) pairs started on entry
+        self.delay = delay  # ms before advancing without input
+
+
+class StageEngine:
+    ''' Runs a table of stages and keeps track of their timers '''
+
+    def __init__(self):
+        self._stages = {}
+        self.current = None
+        self._timers = {}  # source id --> True if owned by the stage
+        self._pending = None  # source id of the pending transition
+
+    def add_stage(self, name, stage):
+        self._stages[name] = stage
+
+    def enter(self, name):
+        ''' Leave the current stage and enter a new one '''
+        self.cancel_stage_timers()
+        self.cancel_transition()
+        self.current = name
+        stage = self._stages[name]
+        if stage.on_enter is not None:
+            stage.on_enter()
+        for ms, callback in stage.timers:
+            self.timeout_add(ms, callback)
+        if stage.delay is not None:
+            self.transition(stage.delay)
+        _logger.debug('stage %s (%d timers)' % (name, self.live_timers()))
+
+    def transition(self, ms):
+        ''' Advance in ms unless a transition is already pending '''
+        if self._pending is not None or self.current is None:
+            return False
+        self._pending = self.timeout_add(ms, self._transition, owned=False)
+        return True
+
+    def _transition(self):
+        self._pending = None
+        self._stages[self.current].action()
+
+    def advance(self):
+        ''' Advance now, instead of any pending transition '''
+        self.cancel_transition()
+        self._stages[self.current].action()
+
+    def transition_pending(self):
+        ''' Is the stage about to advance? '''
+        return self._pending is not None
+
+    def cancel_transition(self):
+        if self._pending is not None:
+            self.source_remove(self._pending)
+            self._pending = None
+
+    def timeout_add(self, ms, callback, owned=True):
+        ''' A one-shot timeout, cancelled with the stage if owned '''
+        source = []
+
+        def fire():
+            self._timers.pop(source[0], None)
+            callback()
+            return False
+
+        source.append(GObject.timeout_add(ms, fire))
+        self._timers[source[0]] = owned
+        return source[0]
+
+    def source_remove(self, source):
+        if self._timers.pop(source, None) is not None:
+            GObject.source_remove(source)
+
+    def cancel_stage_timers(self):
+        for source, owned in self._timers.items():
+            if owned:
+                self.source_remove(source)
+
+    def cancel_all(self):
+        ''' Remove every outstanding timer '''
+        self._pending = None
+        for source in self._timers.keys():
+            self.source_remove(source)
+
+    def live_timers(self):
+        ''' How many timers are outstanding? '''
+        return len(self._timers)
@@ -12,15 +12,14 @@
 
 from gi.repository import Gtk
 
-from sugar3.graphics.radiotoolbutton import RadioToolButton
-from sugar3.graphics.toolbutton import ToolButton
-from sugar3.graphics.combobox import ComboBox
-from sugar3.graphics.toolcombobox import ToolComboBox
+# The sugar3 widgets are imported by the factories that use them, so an
+# activity only pays for the ones it puts in its toolbars.
 
 
 def combo_factory(combo_array, toolbar, callback, cb_arg=None,
                   tooltip=None, default=None):
     '''Factory for making a toolbar combo box'''
+    from sugar3.graphics.combobox import ComboBox
     combo = ComboBox()
     if tooltip is not None and hasattr(combo, 'set_tooltip_text'):
         combo.set_tooltip_text(tooltip)
@@ -64,6 +63,7 @@ def entry_factory(default_string, toolbar, tooltip=None, max=3):
 def button_factory(icon_name, toolbar, callback, cb_arg=None, tooltip=None,
                    accelerator=None):
     '''Factory for making tooplbar buttons'''
+    from sugar3.graphics.toolbutton import ToolButton
     button = ToolButton(icon_name)
     if tooltip is not None:
         button.set_tooltip(tooltip)
@@ -85,6 +85,7 @@ def button_factory(icon_name, toolbar, callback, cb_arg=None, tooltip=None,
 def radio_factory(name, toolbar, callback, cb_arg=None, tooltip=None,
                   group=None):
     ''' Add a radio button to a toolbar '''
+    from sugar3.graphics.radiotoolbutton import RadioToolButton
     button = RadioToolButton(group=group)
     button.set_icon_name(name)
     if callback is not None: